@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark of Zarr codecs and chunk shapes for light-sheet volumes and label volumes.
+Measures the write speed, read speed and compression ratio on synthetic volumes:
+    image: smooth autofluorescence background, Poisson-like noise and bright cells (uint16)
+    labels: piecewise constant regions, like an atlas annotation (uint16)
+The recommended codecs are wired in clearmap_viz.data.get_codecs.
+usage: python benchmarks/bench_codecs.py [--shape 128 1024 1024] [--folder /tmp]
+"""
+
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from numcodecs import Blosc, Zstd, Delta
+
+from clearmap_viz.data import create_zarr, get_codecs
+from clearmap_viz.utils import timestamp_info, timestamp_ok
+
+CODECS = {
+    "none": (None, None),
+    "blosc-lz4-shuffle": (Blosc(cname="lz4", clevel=5, shuffle=Blosc.SHUFFLE), None),
+    "blosc-lz4-bitshuffle": (Blosc(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE), None),
+    "blosc-zstd-shuffle": (Blosc(cname="zstd", clevel=3, shuffle=Blosc.SHUFFLE), None),
+    "zstd": (Zstd(level=3), None),
+    "delta-zstd": (Zstd(level=3), [Delta(dtype="<u2")]),
+    "delta-blosc-zstd-bitshuffle": (Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE), [Delta(dtype="<u2")]),
+    "delta-blosc-lz4-bitshuffle": (Blosc(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE), [Delta(dtype="<u2")]),
+}
+CHUNKS = [(1, 1024, 1024), (16, 512, 512), (64, 256, 256)]
+
+
+def make_image(shape, seed=0):
+    """
+    Return a synthetic light-sheet-like volume (uint16).
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    background = 300 + 200 * np.sin(x / 97) * np.cos(y / 131) + 2 * z
+    img = rng.poisson(np.broadcast_to(background, shape)).astype(np.float32)
+    n_cells = int(np.prod(shape) / 2e4)
+    centers = [rng.integers(2, s - 2, n_cells) for s in shape]
+    for dz in range(-2, 3):
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                img[centers[0] + dz, centers[1] + dy, centers[2] + dx] += 3000 * np.exp(-(dz**2 + dy**2 + dx**2) / 4)
+    return np.clip(img, 0, 65535).astype(np.uint16)
+
+def make_labels(shape, n_regions=600, seed=0, chunk_size=2**14):
+    """
+    Return a synthetic label volume (uint16): each voxel takes the label of its nearest seed point.
+    """
+    rng = np.random.default_rng(seed)
+    seeds = rng.uniform(0, 1, (n_regions, 3)) * shape
+    labels = rng.permutation(np.arange(1, 2 * n_regions))[:n_regions].astype(np.uint16)
+    coarse = np.stack(np.meshgrid(*[np.arange(0, s, 8) + 4 for s in shape], indexing="ij"), axis=-1).reshape(-1, 3)
+    # nearest seed by chunks of points: the (n_points, n_regions) distances of the whole grid would not fit in memory
+    nearest = np.empty(len(coarse), dtype=np.int64)
+    for start in range(0, len(coarse), chunk_size):
+        points = coarse[start:start + chunk_size]
+        # |p - s|^2 without the |p|^2 term, which does not change the nearest seed
+        nearest[start:start + chunk_size] = np.argmin((seeds ** 2).sum(1) - 2 * points @ seeds.T, axis=1)
+    grid = labels[nearest].reshape([len(range(0, s, 8)) for s in shape])
+    return grid.repeat(8, 0).repeat(8, 1).repeat(8, 2)[:shape[0], :shape[1], :shape[2]]
+
+def folder_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+def bench(volume, codec_name, chunks, folder):
+    compressor, filters = CODECS[codec_name]
+    path = Path(folder) / f"{codec_name}.zarr"
+    t0 = perf_counter()
+    arr = create_zarr(path, shape=volume.shape, dtype=volume.dtype, chunks=chunks, compressor=compressor, filters=filters)
+    arr[:] = volume
+    write_time = perf_counter() - t0
+    t0 = perf_counter()
+    read = arr[:]
+    read_time = perf_counter() - t0
+    assert np.array_equal(read, volume)
+    ratio = volume.nbytes / folder_size(path)
+    shutil.rmtree(path)
+    mb = volume.nbytes / 1e6
+    return dict(codec=codec_name, chunks="x".join(map(str, chunks)), write_MBps=mb / write_time, read_MBps=mb / read_time, ratio=ratio)
+
+def main(shape, folder):
+    rows = []
+    for kind, volume in [("image", make_image(shape)), ("labels", make_labels(shape))]:
+        timestamp_info(f"{kind}: {volume.shape} {volume.dtype} ({volume.nbytes / 1e6:.0f} MB)")
+        for chunks in CHUNKS:
+            chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+            for codec_name in CODECS:
+                rows.append(dict(kind=kind, **bench(volume, codec_name, chunks, folder)))
+    df = pd.DataFrame(rows)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200, "display.float_format", "{:,.1f}".format):
+        print(df)
+    for kind in ["image", "labels"]:
+        compressor, filters = get_codecs(kind)
+        timestamp_ok(f"Recommended codecs for {kind} (clearmap_viz.data.get_codecs): {filters or ''} {compressor}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=(128, 1024, 1024), metavar=("Z", "Y", "X"))
+    parser.add_argument("--folder", default=None, help="folder of the temporary Zarr arrays (default: system temporary folder)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        main(tuple(args.shape), folder)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the construction of the edge_index column of the edge geometry table.
+Compares the former per-edge .loc loop with the vectorized run-length expansion,
+on synthetic edge geometries from 10^4 to 10^7 edges.
+usage: python benchmarks/bench_edge_geometry_index.py [--max-loop-edges 100000]
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.graph_tables import edge_index_from_geometry_indices
+from clearmap_viz.utils import timestamp_info, timestamp_ok
+
+
+def make_geometry_indices(n_edges, mean_points=8, seed=0):
+    """
+    Return synthetic contiguous (n_edges, 2) edge geometry indices and the number of points.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.poisson(mean_points - 2, n_edges) + 2
+    stops = np.cumsum(lengths)
+    return np.stack([stops - lengths, stops], axis=1), int(stops[-1])
+
+def loop_edge_index(geometry_indices, n_points):
+    eg_df = pd.DataFrame(index=np.arange(n_points))
+    eg_df["edge_index"] = -1
+    for i, (start, finish) in enumerate(geometry_indices.tolist()):
+        eg_df.loc[start:finish, "edge_index"] = i
+    return eg_df["edge_index"].values
+
+def main(max_loop_edges):
+    for n_edges in [10**4, 10**5, 10**6, 10**7]:
+        geometry_indices, n_points = make_geometry_indices(n_edges)
+        t0 = perf_counter()
+        edge_index = edge_index_from_geometry_indices(geometry_indices, n_points)
+        t_vectorized = perf_counter() - t0
+        msg = f"{n_edges:>10,} edges / {n_points:>11,} points: vectorized {t_vectorized:8.3f} s"
+        if n_edges <= max_loop_edges:
+            t0 = perf_counter()
+            expected = loop_edge_index(geometry_indices, n_points)
+            t_loop = perf_counter() - t0
+            assert np.array_equal(edge_index, expected)
+            msg += f" | loop {t_loop:8.3f} s (x{t_loop / t_vectorized:,.0f})"
+        timestamp_info(msg)
+    timestamp_ok("Done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-loop-edges", type=int, default=10**4, help="largest graph on which the former loop is also timed")
+    main(parser.parse_args().max_loop_edges)
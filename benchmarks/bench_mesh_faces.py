@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the peak memory and time needed to build the face array of PyVista meshes of increasing size.
+Compares the former np.insert(faces, 0, 3, axis=1).flatten() with make_vtk_faces (preallocated)
+and make_polydata (PolyData.from_regular_faces, if PyVista is installed).
+usage: python benchmarks/bench_mesh_faces.py [--max-faces 100000000]
+"""
+
+import argparse
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from clearmap_viz.meshing import make_vtk_faces, make_polydata, pv
+from clearmap_viz.utils import timestamp_info, timestamp_ok
+
+
+def measure(func, *args):
+    """
+    Return the duration (s) and the peak memory allocated by numpy during the call (bytes).
+    Note: memory allocated by VTK itself is not traced.
+    """
+    tracemalloc.start()
+    t0 = perf_counter()
+    result = func(*args)
+    duration = perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return duration, peak
+
+def insert_faces(faces):
+    return np.insert(faces, 0, 3, axis=1).flatten()
+
+def main(max_faces):
+    n_faces = 10**5
+    while n_faces <= max_faces:
+        faces = np.random.default_rng(0).integers(0, n_faces, (n_faces, 3), dtype=np.int64)
+        coordinates = np.zeros((n_faces, 3), dtype=np.float32)
+        msg = f"{n_faces:>12,} faces ({faces.nbytes / 1e6:8.1f} MB):"
+        for name, func, args in [("np.insert", insert_faces, (faces,)),
+                                 ("make_vtk_faces", make_vtk_faces, (faces,)),
+                                 ("make_polydata", make_polydata, (coordinates, faces))]:
+            if name == "make_polydata" and pv is None:
+                continue
+            duration, peak = measure(func, *args)
+            msg += f" | {name} {duration:6.2f} s, peak {peak / 1e6:8.1f} MB"
+        timestamp_info(msg)
+        n_faces *= 10
+    timestamp_ok("Done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-faces", type=int, default=10**7, help="size of the largest mesh")
+    main(parser.parse_args().max_faces)
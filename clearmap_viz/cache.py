@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains utils to cache on disk the results computed from a source file (e.g. a graph):
+columns of tables as Parquet, and arrays as NPY files that are memory-mapped when read.
+Each source file has a cache entry (a folder in CACHE_DIR) keyed by its path, modification time and size,
+so that an entry is invalidated as soon as the source file changes.
+The least recently used entries are evicted when the cache exceeds CACHE_MAX_SIZE_GB.
+"""
+
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.graph_tables import property_columns
+from clearmap_viz.utils import timestamp_info
+
+try:
+    from clearmap_viz.params import CACHE_DIR
+except ImportError:
+    CACHE_DIR = Path.home() / ".cache/clearmap_viz"
+try:
+    from clearmap_viz.params import CACHE_MAX_SIZE_GB
+except ImportError:
+    CACHE_MAX_SIZE_GB = 50
+
+
+def source_info(fpath):
+    """
+    Return the identity of a source file: resolved path, modification time (ns) and size (bytes).
+    """
+    fpath = Path(fpath).expanduser().resolve()
+    stat = fpath.stat()
+    return dict(path=str(fpath), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+def file_key(fpath):
+    """
+    Return the cache key of a source file (hash of its path, modification time and size).
+    """
+    info = source_info(fpath)
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()[:20]
+
+def get_cache_entry(fpath, cache_dir=None, create=True):
+    """
+    Return the cache folder of a source file (None if it does not exist and create is False).
+    Creating an entry removes the stale entries of the same file (same path, older mtime or size).
+    The entry is written under a temporary name, then renamed (as save_arrays): processes creating it at the same time
+    do not fail, and never see an entry without its source.json.
+    """
+    cache_dir = Path(cache_dir or CACHE_DIR).expanduser()
+    entry = cache_dir / file_key(fpath)
+    if entry.exists():
+        os.utime(entry)  # last access time, used for eviction
+        return entry
+    if not create:
+        return None
+    info = source_info(fpath)
+    # not clear_cache: it would also remove this entry if another process has just created it
+    entries = list_cache_entries(cache_dir)
+    for stale_entry in entries.loc[(entries["source"] == info["path"]) & (entries["entry"] != entry), "entry"]:
+        shutil.rmtree(stale_entry, ignore_errors=True)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_entry = cache_dir / f"{entry.name}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    tmp_entry.mkdir()
+    with open(tmp_entry / "source.json", "w") as f:
+        json.dump(info, f)
+    try:
+        tmp_entry.rename(entry)
+    except OSError:
+        # created in the meantime by another process
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    return entry
+
+def list_cache_entries(cache_dir=None):
+    """
+    Return a dataframe of the cache entries with their source file, size and last access time.
+    """
+    cache_dir = Path(cache_dir or CACHE_DIR).expanduser()
+    rows = []
+    for entry in cache_dir.glob("*/source.json"):
+        if ".tmp" in entry.parent.name:
+            continue  # entry being created (see get_cache_entry)
+        with open(entry) as f:
+            info = json.load(f)
+        size = sum(p.stat().st_size for p in entry.parent.rglob("*") if p.is_file())
+        rows.append(dict(entry=entry.parent, source=info["path"], size=size, last_access=entry.parent.stat().st_mtime))
+    return pd.DataFrame(rows, columns=["entry", "source", "size", "last_access"])
+
+def clear_cache(fpath=None, cache_dir=None):
+    """
+    Remove the cache entries of a source file (whatever its version), or all entries if fpath is None.
+    """
+    entries = list_cache_entries(cache_dir)
+    if fpath is not None:
+        entries = entries[entries["source"] == str(Path(fpath).expanduser().resolve())]
+    for entry in entries["entry"]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+def evict_cache(max_size_gb=None, cache_dir=None):
+    """
+    Remove the least recently used cache entries until the cache is smaller than max_size_gb.
+    """
+    max_size = (CACHE_MAX_SIZE_GB if max_size_gb is None else max_size_gb) * 1e9
+    entries = list_cache_entries(cache_dir).sort_values("last_access")
+    total_size = entries["size"].sum()
+    for entry, size in zip(entries["entry"], entries["size"]):
+        if total_size <= max_size:
+            break
+        timestamp_info(f"Evicting cache entry {entry} ({size / 1e9:.1f} GB)")
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
+
+#####################################
+### Cache of LazyTable (Parquet) ###
+#####################################
+
+def save_table(entry, name, table):
+    """
+    Save the computed columns of a LazyTable to <entry>/<name>.parquet.
+    Columns already cached in the file and not computed in the table are kept.
+    Multi-dimensional columns are stored as name_0, name_1... and recorded in <entry>/<name>.json.
+    """
+    fpath, meta_fpath = Path(entry) / f"{name}.parquet", Path(entry) / f"{name}.json"
+    data, multi = {}, {}
+    if fpath.exists():
+        data.update(pd.read_parquet(fpath).to_dict("series"))
+        with open(meta_fpath) as f:
+            multi.update(json.load(f))
+    for column in table.cached_columns:
+        values = table.array(column)
+        if values.ndim > 1:
+            multi[column] = int(np.prod(values.shape[1:]))
+        data.update(property_columns(column, values))
+    if not data:
+        return
+    pd.DataFrame(data, copy=False).to_parquet(fpath)
+    with open(meta_fpath, "w") as f:
+        json.dump(multi, f)
+
+def load_table(entry, name, table, transform=None):
+    """
+    Register the columns cached in <entry>/<name>.parquet in a LazyTable.
+    They are read from the file (one column at a time) instead of being computed.
+    transform: optional function applied to each column after reading (e.g. a dtype downcast)
+    returns: list of the cached column names
+    """
+    fpath, meta_fpath = Path(entry) / f"{name}.parquet", Path(entry) / f"{name}.json"
+    if not fpath.exists():
+        return []
+    import pyarrow.parquet as pq
+    with open(meta_fpath) as f:
+        multi = json.load(f)
+    stored = pq.read_schema(fpath).names
+    transform = transform or (lambda values: values)
+    split = {f"{column}_{i}" for column, n in multi.items() for i in range(n)}
+    columns = [column for column in stored if column not in split] + list(multi)
+    for column in columns:
+        stored_columns = [f"{column}_{i}" for i in range(multi[column])] if column in multi else [column]
+        read = lambda stored_columns=stored_columns: pd.read_parquet(fpath, columns=stored_columns).to_numpy()
+        if column in multi:
+            table.register(column, lambda read=read: transform(read()))
+        else:
+            table.register(column, lambda read=read: transform(read()[:, 0]))
+    return columns
+
+###########################################
+### Cache of arrays (memory-mapped NPY) ###
+###########################################
+
+def save_arrays(folder, arrays):
+    """
+    Save a list of arrays as <folder>/<i>.npy.
+    The folder is written under a temporary name, then renamed: other processes never read a partial folder.
+    """
+    folder = Path(folder)
+    tmp_folder = folder.with_name(f"{folder.name}.tmp{os.getpid()}")
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+    for i, values in enumerate(arrays):
+        np.save(tmp_folder / f"{i}.npy", np.asarray(values), allow_pickle=False)
+    try:
+        tmp_folder.rename(folder)
+    except OSError:
+        # saved in the meantime by another process
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+def load_arrays(folder, mmap_mode="r"):
+    """
+    Return the list of arrays saved with save_arrays, memory-mapped (None if they are not saved).
+    """
+    folder = Path(folder)
+    if not folder.is_dir():
+        return None
+    n_arrays = len(list(folder.glob("*.npy")))
+    return [np.load(folder / f"{i}.npy", mmap_mode=mmap_mode, allow_pickle=False) for i in range(n_arrays)]
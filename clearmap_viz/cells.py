@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains utils to count the cells detected by ClearMap by atlas region, for several brains at once.
+Cell tables are loaded as (memory-mapped) structured arrays, without pickle, and counted with np.bincount:
+the result is a samples x regions matrix, optionally rolled up to parent regions and to metaregions
+with the ontology index (see ontology.OntologyIndex).
+"""
+
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.ontology import METAREGIONS, id_to_index
+from clearmap_viz.utils import timestamp_info, timestamp_warning
+
+
+def load_cells(fpath, fields=None):
+    """
+    Load a ClearMap cell table (NPY file of a structured array) without pickle, memory-mapped.
+    input:
+        fpath: str or Path
+        fields: list of the fields to keep (default: all)
+    returns: structured array (one record per cell)
+    """
+    try:
+        cells = np.load(Path(fpath).expanduser(), mmap_mode="r", allow_pickle=False)
+    except ValueError as e:
+        raise ValueError(f"{fpath} contains Python objects (e.g. a 'name' column of dtype object) and cannot be "
+                         "loaded without pickle: save it with fixed-size fields (e.g. '<U256') or an 'id' field") from e
+    if cells.dtype.names is None:
+        raise ValueError(f"{fpath} is not a cell table (structured array)")
+    return cells[list(fields)] if fields is not None else cells
+
+def cell_labels(cells, ontology, field=None):
+    """
+    Return the ontology row of the region of each cell (-1 if the region is not in the ontology, e.g. 0 = outside the brain).
+    input:
+        cells: structured array (see load_cells)
+        ontology: OntologyIndex (see ontology.load_ontology_index)
+        field: field of the region of the cells - atlas ids, or region names (string field)
+            (default: "id" if the table has it, else "name")
+    returns: (n_cells,) int64 array
+    """
+    if field is None:
+        field = "id" if "id" in cells.dtype.names else "name"
+    values = np.asarray(cells[field])
+    if values.dtype.kind in "US":
+        # few distinct names: map them once, then broadcast to the cells
+        names, inverse = np.unique(values, return_inverse=True)
+        return id_to_index(ontology.names.astype(names.dtype), names)[inverse.ravel()]
+    return ontology.index(values.astype(np.int64, copy=False))
+
+def count_cells(sources, ontology, field=None, rollup=False):
+    """
+    Count the cells of several brains by atlas region, in one pass per brain (np.bincount).
+    input:
+        sources: dict of sample name -> cell table (path or structured array), or list of paths (named after their stem)
+        ontology: OntologyIndex (see ontology.load_ontology_index)
+        field: field of the region of the cells (see cell_labels)
+        rollup: if True, the count of a region includes the cells of all its descendants (see OntologyIndex.rollup)
+    returns: dataframe samples x regions (columns: atlas ids, in the order of the ontology)
+    Examples:
+        ontology = load_ontology_index(ontology_fpath)
+        counts = count_cells({"450": cells_fpath_450, "452": cells_fpath_452}, ontology)
+        by_metaregion = metaregion_counts(counts, ontology)
+    """
+    if not isinstance(sources, dict):
+        sources = {Path(source).stem: source for source in sources}
+    n_regions = len(ontology)
+    counts = np.zeros((len(sources), n_regions), dtype=np.int64)
+    for i, (sample, source) in enumerate(sources.items()):
+        cells = load_cells(source) if isinstance(source, (str, Path)) else source
+        labels = cell_labels(cells, ontology, field=field)
+        unassigned = int((labels < 0).sum())
+        counts[i] = np.bincount(labels[labels >= 0], minlength=n_regions)
+        timestamp_info(f"{sample}: {len(labels):,} cells, {unassigned:,} outside the ontology regions")
+    if rollup:
+        counts = ontology.rollup(counts)
+    return pd.DataFrame(counts, index=pd.Index(list(sources), name="sample"),
+                        columns=pd.Index(ontology.ids, name="id"))
+
+def rollup_counts(counts, ontology):
+    """
+    Add the counts of each region to all its ancestors.
+    input:
+        counts: (n_samples, n_regions) array or dataframe, in the order of the ontology
+        ontology: OntologyIndex
+    returns: same type as counts
+    """
+    values = ontology.rollup(np.asarray(counts))
+    if isinstance(counts, pd.DataFrame):
+        return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+    return values
+
+def level_counts(counts, ontology, depth):
+    """
+    Sum the (direct, not rolled up) counts of the regions by ancestor at a given depth of the ontology.
+    returns: dataframe samples x regions of this depth (columns: names)
+    """
+    rows, values = ontology.aggregate(np.asarray(counts), ontology.ancestor_at_depth(depth))
+    return pd.DataFrame(values, index=getattr(counts, "index", None), columns=pd.Index(ontology.names[rows], name="region"))
+
+def metaregion_counts(counts, ontology, metaregions=METAREGIONS):
+    """
+    Sum the (direct, not rolled up) counts of the regions of each metaregion.
+    returns: dataframe samples x metaregions (columns: names of the metaregions)
+    """
+    meta = ontology.metaregion_index(metaregions)
+    if np.asarray(counts)[:, meta < 0].any():
+        timestamp_warning("Some cells are in regions outside all metaregions: they are not counted")
+    rows, values = ontology.aggregate(np.asarray(counts), meta)
+    return pd.DataFrame(values, index=getattr(counts, "index", None), columns=pd.Index(ontology.names[rows], name="metaregion"))
+
+def counts_to_long(counts, ontology, metaregions=METAREGIONS, drop_empty=True):
+    """
+    Return the samples x regions counts as a long dataframe (one row per sample and region),
+    with the name, acronym, color, order and metaregion of the regions (for plots with seaborn).
+    """
+    meta = ontology.metaregion_index(metaregions)
+    regions = pd.DataFrame({
+        "id": ontology.ids,
+        "name": ontology.names,
+        "acronym": ontology.acronyms,
+        "color": ontology.colors,
+        "order": ontology.orders,
+        "metaregion": np.where(meta >= 0, ontology.names[np.maximum(meta, 0)], None),
+    })
+    df = counts.rename_axis(index="sample", columns="id").stack().rename("count").reset_index()
+    df = df.merge(regions, on="id", how="left")
+    if drop_empty:
+        df = df[df.groupby("id")["count"].transform("sum") > 0]
+    return df.sort_values(["order", "sample"]).reset_index(drop=True)
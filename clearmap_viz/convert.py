@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains the conversion of 3D images (TIF, NPY, Zarr, HDF5 or dask arrays) to chunked, compressed
+Zarr arrays or to NPY files, streamed slab by slab on a pool of processes.
+usage: python -m clearmap_viz.convert source.tif target.zarr [--slab-size 64] [--processes 8]
+"""
+
+
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import zarr
+
+from clearmap_viz.data import load_img, create_zarr, get_codecs, DEFAULT_ZARR_CHUNKS
+from clearmap_viz.utils import timestamp_info, timestamp_ok
+
+
+def _write_slab(source, target, z_start, z_stop, swapaxes):
+    """
+    Read the z-slices [z_start, z_stop) of the source and write them in the target. Return the number of bytes.
+    source and target are paths (opened in the worker process) or arrays (in a thread).
+    """
+    if isinstance(source, (str, Path)):
+        source = load_img(source)
+    slab = np.asarray(source[z_start:z_stop])
+    target = str(target)
+    if target.endswith(".npy"):
+        out = np.load(target, mmap_mode="r+")
+        if swapaxes:
+            out[:, :, z_start:z_stop] = slab.swapaxes(0,2)
+        else:
+            out[z_start:z_stop] = slab
+        out.flush()
+    else:
+        zarr.open_array(target, mode="r+")[z_start:z_stop] = slab
+    return slab.nbytes
+
+def convert_img(source, target, slab_size=64, processes=None, chunks=DEFAULT_ZARR_CHUNKS, swapaxes=True, kind="image", compressor=None, filters=None):
+    """
+    Convert a 3D image to a chunked, compressed Zarr array or to a NPY file, streaming it slab by slab.
+    The slabs (slab_size z-slices) are read and written in parallel: on a pool of processes if the source is a file,
+    on a pool of threads if it is an array.
+    input:
+        source: str or Path (any format supported by load_img) or (z, y, x) array-like (e.g. dask array)
+        target: str or Path - .zarr (z, y, x order) or .npy (x, y, z order of ClearMap if swapaxes, as save_img_npy)
+        slab_size: number of z-slices per slab (rounded up to a multiple of the Zarr chunks along z)
+        processes: number of workers (default: number of CPUs)
+        chunks: chunk shape of the Zarr array (z, y, x)
+        kind: "image" or "labels" - selects the recommended codecs of the Zarr array (see data.get_codecs)
+        compressor, filters: numcodecs codecs of the Zarr array, instead of the recommended ones (see data.create_zarr)
+    returns: dict with the number of bytes, the duration (s) and the throughput (MB/s)
+    """
+    source_array = load_img(source) if isinstance(source, (str, Path)) else source
+    shape, dtype, target = source_array.shape, source_array.dtype, str(target)
+    if target.endswith(".npy"):
+        np.lib.format.open_memmap(target, mode="w+", dtype=dtype, shape=shape[::-1] if swapaxes else shape).flush()
+    else:
+        chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+        # slabs are aligned on the chunks, so that two workers never write the same chunk
+        slab_size = -(-slab_size // chunks[0]) * chunks[0]
+        if compressor is None:
+            compressor, filters = get_codecs(kind)
+        create_zarr(target, shape=shape, dtype=dtype, chunks=chunks, compressor=compressor, filters=filters)
+    processes = processes or os.cpu_count()
+    Executor = ProcessPoolExecutor if isinstance(source, (str, Path)) else ThreadPoolExecutor
+    task_source = str(source) if isinstance(source, (str, Path)) else source_array
+    timestamp_info(f"Converting {source if isinstance(source, (str, Path)) else 'array'} {shape} {dtype} to {target} with {processes} workers")
+    t0 = perf_counter()
+    n_bytes = 0
+    # worker processes are spawned: forking after zarr/dask threads have started can deadlock
+    executor_kwargs = dict(mp_context=multiprocessing.get_context("spawn")) if Executor is ProcessPoolExecutor else {}
+    with Executor(max_workers=processes, **executor_kwargs) as executor:
+        futures = [executor.submit(_write_slab, task_source, target, z, min(z + slab_size, shape[0]), swapaxes)
+                   for z in range(0, shape[0], slab_size)]
+        for i, future in enumerate(futures):
+            n_bytes += future.result()
+            duration = perf_counter() - t0
+            timestamp_info(f"Slab {i + 1}/{len(futures)}: {n_bytes / 1e6:,.0f} MB in {duration:.1f} s ({n_bytes / 1e6 / duration:,.1f} MB/s)")
+    duration = perf_counter() - t0
+    throughput = n_bytes / 1e6 / duration
+    timestamp_ok(f"Converted {n_bytes / 1e6:,.0f} MB in {duration:.1f} s ({throughput:,.1f} MB/s) to {target}")
+    return dict(n_bytes=n_bytes, duration=duration, throughput=throughput)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a 3D image to a chunked, compressed Zarr array or to a NPY file.")
+    parser.add_argument("source", help="image file (TIF, NPY, Zarr, N5, HDF5)")
+    parser.add_argument("target", help="output file (.zarr or .npy)")
+    parser.add_argument("--slab-size", type=int, default=64, help="number of z-slices per slab")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunks", type=int, nargs=3, default=DEFAULT_ZARR_CHUNKS, metavar=("Z", "Y", "X"), help="chunk shape of the Zarr array")
+    parser.add_argument("--labels", action="store_true", help="the image is a label image (selects the codecs of the Zarr array)")
+    parser.add_argument("--no-swapaxes", action="store_true", help="write NPY files in (z, y, x) order instead of ClearMap's (x, y, z)")
+    args = parser.parse_args()
+    convert_img(args.source, args.target, slab_size=args.slab_size, processes=args.processes,
+                chunks=tuple(args.chunks), swapaxes=not args.no_swapaxes, kind="labels" if args.labels else "image")
+
+
+if __name__ == "__main__":
+    main()
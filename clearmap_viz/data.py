@@ -13,36 +13,209 @@ This module contains utils to interact with the data of the project.
 
 
 import json
-import sys
+import shutil
 from pathlib import Path
-from natsort import natsorted
 
 import dask.array as da
 import numpy as np
-import pandas as pd
 import tifffile
+import zarr
 
+from clearmap_viz.cache import file_key
 from clearmap_viz.utils import timestamp_error, BOLD, RED, ORANGE, GREEN, ENDC, timestamp_info
 
 
-def load_img(fpath, swapaxes=True):
+# in-plane tile of the loaded images, in (y, x) order: one slice per chunk along the other dimensions (see default_chunks)
+DEFAULT_TILE = (2048, 2048)
+# chunk shape of the Zarr arrays written by the package (see get_codecs)
+DEFAULT_ZARR_CHUNKS = (16, 512, 512)
+
+def default_chunks(shape):
     """
-    Load a 3D image from a TIF or a NPY file.
-    Note: The array is reoriented to have the first dimension as the z-axis.
-    input: (str or Path)
-    returns: dask array
+    Return the default chunk shape of an image of this shape (see load_img): one slice per chunk along the first
+    dimensions and DEFAULT_TILE over the last two, clipped to the shape.
+    A last dimension of at most 4 values (RGB/RGBA channels) is kept whole, and the two before it are tiled.
+    Examples:
+        default_chunks((500, 4000, 3000)) -> (1, 2048, 2048)
+        default_chunks((1000, 1500)) -> (1000, 1500)
+        default_chunks((500, 4000, 3000, 3)) -> (1, 2048, 2048, 3)
     """
-    if isinstance(fpath, Path):
-        fpath = str(fpath)
+    shape = tuple(shape)
+    channels = shape[-1:] if len(shape) >= 3 and shape[-1] <= 4 else ()
+    plane = shape[:len(shape) - len(channels)]
+    chunks = ((1,) * len(plane) + DEFAULT_TILE)[-len(plane):] if plane else ()
+    return tuple(min(c, max(n, 1)) for c, n in zip(chunks + channels, shape))
+
+def open_img(fpath, key=None):
+    """
+    Open a 3D image without reading it: return an array-like (memmap, zarr array or HDF5Dataset).
+    Supported formats:
+        TIF: memory-mapped when the data is contiguous and uncompressed, else read by strips/tiles (tifffile aszarr)
+        NPY: memory-mapped
+        Zarr (.zarr) and N5 (.n5): key is the path of the array within the group, if any
+        HDF5 (.h5, .hdf5): key is the name of the dataset (default: the first dataset)
+    """
+    fpath = str(fpath)
     if fpath.endswith('.tif') or fpath.endswith('.tiff'):
-        return tifffile.imread(fpath)
+        try:
+            return tifffile.memmap(fpath, mode="r")
+        except ValueError:
+            # compressed or non contiguous data
+            return zarr.open(tifffile.imread(fpath, aszarr=True), mode="r")
     elif fpath.endswith('.npy'):
-        arr = np.load(fpath, mmap_mode="r")
-        if swapaxes:
-            arr = arr.swapaxes(0,2)
-        return arr
+        return np.load(fpath, mmap_mode="r")
+    elif fpath.rstrip("/").endswith('.zarr') or fpath.rstrip("/").endswith('.n5'):
+        store = fpath
+        if fpath.rstrip("/").endswith('.n5'):
+            if not hasattr(zarr, "N5Store"):
+                raise ValueError(f"Reading N5 files ({fpath}) requires zarr<3")
+            store = zarr.N5Store(fpath)
+        arr = zarr.open(store, mode="r")
+        return arr[key] if key is not None else arr
+    elif fpath.endswith('.h5') or fpath.endswith('.hdf5'):
+        return HDF5Dataset(fpath, key=key)
+    else:
+        raise ValueError(f"Unknown file format for {fpath}")
+
+
+class HDF5Dataset:
+    """
+    Array-like dataset of an HDF5 file, which opens the file for each read and closes it:
+    no file handle is left open by the lazy arrays of load_img, and the array can be sent to worker processes.
+    input:
+        fpath: path of the HDF5 file
+        key: name of the dataset (default: the first dataset)
+    """
+    def __init__(self, fpath, key=None):
+        import h5py
+        self.fpath = str(fpath)
+        with h5py.File(self.fpath, "r") as f:
+            if key is None:
+                key = next(name for name, item in f.items() if isinstance(item, h5py.Dataset))
+            dataset = f[key]
+            self.key, self.shape, self.dtype, self.chunks = key, dataset.shape, dataset.dtype, dataset.chunks
+        self.ndim = len(self.shape)
+
+    def __repr__(self):
+        return f"HDF5Dataset({self.fpath}, key={self.key}, {self.shape}, {self.dtype})"
+
+    def __getitem__(self, key):
+        import h5py
+        with h5py.File(self.fpath, "r") as f:
+            return f[self.key][key]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[()]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def crop_slicing(shape, slicing=None, center=None, size=None):
+    """
+    Return the box of an image of a given shape defined by a slicing or by its center and size, clipped to the image.
+    input:
+        shape: shape of the image
+        slicing: tuple of slices (missing dimensions are not cropped) - step must be 1
+        center: coordinates of the center of the box
+        size: int or sequence of ints - size of the box along each dimension
+    returns: tuple of slices with explicit start and stop
+    Examples:
+        crop_slicing((100, 100, 100), center=(50, 50, 95), size=20)
+        # (slice(40, 60), slice(40, 60), slice(85, 100))
+    """
+    if center is not None:
+        if size is None:
+            raise ValueError("size is required with center")
+        size = np.broadcast_to(np.asarray(size, dtype=int), (len(center),))
+        starts = np.asarray(center, dtype=int) - size // 2
+        slicing = tuple(slice(int(start), int(start + s)) for start, s in zip(starts, size))
+    slicing = tuple(slicing or ()) + (slice(None),) * (len(shape) - len(slicing or ()))
+    box = []
+    for s, n in zip(slicing, shape):
+        if s.step not in (None, 1):
+            raise ValueError(f"Only contiguous crops are supported, got {s}")
+        start = 0 if s.start is None else min(max(s.start, 0), n)
+        stop = n if s.stop is None else min(max(s.stop, start), n)
+        box.append(slice(start, stop))
+    return tuple(box)
+
+
+class CroppedArray:
+    """
+    Array-like box of an array-like opened with open_img (memmap, zarr array, HDF5Dataset):
+    only the indexed part of the box is read from the file (its strips/tiles or chunks).
+    input:
+        arr: array-like
+        slicing: tuple of slices with explicit start and stop (see crop_slicing)
+    """
+    def __init__(self, arr, slicing):
+        self.arr = arr
+        self.slicing = slicing
+        self.shape = tuple(s.stop - s.start for s in slicing)
+        self.dtype = arr.dtype
+        self.ndim = len(self.shape)
+
+    def __repr__(self):
+        return f"CroppedArray({self.shape}, {self.dtype}, slicing={self.slicing})"
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        shifted = []
+        for k, s, n in zip(key, self.slicing, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported")
+                shifted.append(slice(s.start + start, s.start + max(stop, start), step))
+            else:
+                k = int(k)
+                shifted.append(s.start + (k + n if k < 0 else k))
+        return self.arr[tuple(shifted)]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = np.asarray(self[()])
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def load_img(fpath, swapaxes=True, chunks=None, key=None, slicing=None, center=None, size=None):
+    """
+    Load a 3D image lazily, as a chunked dask array: no voxel is read until it is used.
+    See open_img for the supported formats (TIF, NPY, Zarr, N5, HDF5).
+    Note: The 3D NPY arrays are reoriented to have the first dimension as the z-axis. The swap is a view (no copy).
+    A crop (slicing, or center and size) is applied to the file itself: the dask array only spans the crop,
+    and computing it reads the strips/tiles or chunks of the crop, whatever the size of the whole image.
+    input: (str or Path)
+        chunks: chunk shape in the (z, y, x) order of the returned array (default: see default_chunks);
+            "native" keeps the chunks of the file (Zarr, N5, HDF5)
+        key: array or dataset name within Zarr, N5 and HDF5 files
+        slicing: tuple of slices in the (z, y, x) order of the returned array - crop to load
+        center, size: center (z, y, x) and size (int or 3 ints) of the crop to load (instead of slicing)
+    returns: dask array
+    Examples:
+        crop = load_img(fpath, center=(1200, 3000, 2500), size=100).compute()
+    """
+    fpath = str(fpath)
+    arr = open_img(fpath, key=key)
+    swap = swapaxes and fpath.endswith('.npy') and len(arr.shape) == 3
+    if chunks == "native":
+        chunks = getattr(arr, "chunks", None) or "auto"
     else:
-        timestamp_error(f"Unknown file format for {fpath}")
+        # the chunks are given in the order of the returned array
+        chunks = tuple(chunks or default_chunks(arr.shape[::-1] if swap else arr.shape))
+        if swap:
+            chunks = chunks[::-1]
+    if slicing is not None or center is not None:
+        shape = arr.shape[::-1] if swap else arr.shape
+        box = crop_slicing(shape, slicing=slicing, center=center, size=size)
+        arr = CroppedArray(arr, box[::-1] if swap else box)
+        if isinstance(chunks, tuple):
+            chunks = tuple(min(c, max(n, 1)) for c, n in zip(chunks, arr.shape))
+    # the dask name identifies the file instead of hashing its content (dask tokenizes memmaps by hashing the data)
+    name = "load_img-" + da.core.tokenize(file_key(fpath), key, getattr(arr, "slicing", None), chunks)
+    arr = da.from_array(arr, chunks=chunks, name=name)
+    if swap:
+        arr = arr.swapaxes(0,2)
+    return arr
 
 def save_json(path, data):
     """
@@ -51,10 +224,169 @@ def save_json(path, data):
     with open(path, "w") as f:
         json.dump(data, f)
 
-def save_img_npy(path, img):
+def save_img_npy(path, img, slab_size=64):
     """
     Save a 3D image to a NPY file.
     Note: The array is reoriented to have the first dimension as the z-axis.
-    input: (str or Path)
+    The image (numpy or dask array) is written slab by slab (slab_size z-slices) in a memory-mapped file,
+    so that it is never loaded entirely.
+    input: (str or Path) - ".npy" is appended if the path has no extension
+    """
+    path = Path(path)
+    # as np.save: the extension is added if missing
+    if not path.suffix:
+        path = path.with_suffix(".npy")
+    out = np.lib.format.open_memmap(str(path), mode="w+", dtype=img.dtype, shape=img.shape[::-1])
+    for z in range(0, img.shape[0], slab_size):
+        out[:, :, z:z + slab_size] = np.asarray(img[z:z + slab_size]).swapaxes(0,2)
+    out.flush()
+
+def get_codecs(kind="image"):
+    """
+    Return the recommended (compressor, filters) to store a volume in Zarr, measured with benchmarks/bench_codecs.py:
+        image: Blosc-LZ4 with byte shuffle - ratio ~1.8 on light-sheet-like data (Zstd variants: 1.7-1.9),
+            at ~90% of the uncompressed write speed and 2-3x the read speed of Zstd
+        labels: Zstd - ratio > 80 on label-like data and read as fast as uncompressed data;
+            a Delta filter with bit shuffle compressed 2-20x less and read 3x slower
+    Chunks of 16 z-slices gave the fastest reads (see DEFAULT_ZARR_CHUNKS).
+    """
+    from numcodecs import Blosc, Zstd
+    if kind == "image":
+        return Blosc(cname="lz4", clevel=5, shuffle=Blosc.SHUFFLE), None
+    elif kind == "labels":
+        return Zstd(level=3), None
+    raise ValueError(f"kind {kind} not recognized")
+
+def create_zarr(path, shape, dtype, chunks=DEFAULT_ZARR_CHUNKS, compressor="default", filters=None):
+    """
+    Create an empty Zarr array (Zarr v2 format, readable by zarr 2 and 3).
+    compressor: numcodecs codec, None for no compression, "default" for the default of zarr
+    filters: list of numcodecs codecs applied before compression (e.g. Delta)
+    """
+    kwargs = {} if compressor == "default" else dict(compressor=compressor)
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        if compressor != "default":
+            kwargs = dict(compressors=compressor)
+        return zarr.create_array(str(path), shape=shape, dtype=dtype, chunks=chunks, filters=filters,
+                                 zarr_format=2, overwrite=True, **kwargs)
+    return zarr.open_array(str(path), mode="w", shape=shape, dtype=dtype, chunks=chunks, filters=filters, **kwargs)
+
+def compact_labels(labels):
+    """
+    Return integer labels with the smallest integer dtype that can hold them.
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return labels
+    dtype = np.result_type(np.min_scalar_type(labels.min()), np.min_scalar_type(labels.max()))
+    return labels.astype(dtype, copy=False)
+
+def sample_volume(volume, indices, chunk_shape=None):
+    """
+    Return the values of a 3D volume at integer voxel indices, reading each chunk of the volume at most once.
+    The volume can be a numpy, memory-mapped, zarr or dask array: it is never loaded entirely.
+    Points are grouped by chunk and, for each chunk, only the bounding box of its points is read.
+    input:
+        volume: 3D array-like
+        indices: (n, 3) int array of voxel indices (within the volume shape)
+        chunk_shape: shape of the blocks read at once (default: chunks of the volume, or 256^3)
+    returns: (n,) array with the dtype of the volume
+    """
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+    if chunk_shape is None:
+        chunk_shape = getattr(volume, "chunksize", None) or getattr(volume, "chunks", None) or (256, 256, 256)
+    chunk_shape = np.array(chunk_shape, dtype=np.int64)
+    values = np.empty(len(indices), dtype=volume.dtype)
+    if len(indices) == 0:
+        return values
+    grid_shape = -(-np.array(volume.shape) // chunk_shape)
+    chunk_ids = np.ravel_multi_index(tuple((indices // chunk_shape).T), tuple(grid_shape))
+    order = np.argsort(chunk_ids, kind="stable")
+    boundaries = np.flatnonzero(np.diff(chunk_ids[order])) + 1
+    for group in np.split(order, boundaries):
+        group_indices = indices[group]
+        start, stop = group_indices.min(axis=0), group_indices.max(axis=0) + 1
+        block = np.asarray(volume[tuple(slice(a, b) for a, b in zip(start, stop))])
+        values[group] = block[tuple((group_indices - start).T)]
+    return values
+
+#########################
+### Multiscale images ###
+#########################
+
+def pyramid_path(fpath):
+    """
+    Return the path of the multiscale pyramid of an image file: <fpath>.pyramid.zarr, next to the file.
+    """
+    return Path(str(fpath).rstrip("/") + ".pyramid.zarr")
+
+def build_pyramid(fpath, downscale=(2, 2, 2), min_size=512, labels=False, chunks=DEFAULT_ZARR_CHUNKS, num_workers=None, overwrite=False):
+    """
+    Write the downsampled levels of a 3D image in a Zarr group next to the file (see pyramid_path).
+    Level i is level i-1 downsampled by downscale (z, y, x): averaged for images, subsampled for labels
+    (averaging would mix the labels). Levels are added until the largest dimension is smaller than min_size.
+    Each level is computed chunk by chunk from the previous one, in parallel (dask threads),
+    and compressed with the recommended codecs (see get_codecs).
+    The full-resolution level is not copied: it is read from the source file (see load_pyramid).
+    input:
+        fpath: str or Path - image file (any format supported by load_img)
+        num_workers: number of threads (default: number of CPUs)
+    returns: Path of the pyramid
+    """
+    import dask
+    path = pyramid_path(fpath)
+    if path.exists() and not overwrite:
+        timestamp_info(f"Pyramid already exists: {path}")
+        return path
+    downscale = tuple(downscale)
+    compressor, filters = get_codecs("labels" if labels else "image")
+    if path.exists():
+        shutil.rmtree(path)
+    level = load_img(fpath)
+    i = 0
+    with dask.config.set(scheduler="threads", num_workers=num_workers):
+        while max(level.shape) // max(downscale) >= min_size:
+            i += 1
+            if labels:
+                level = level[tuple(slice(None, None, f) for f in downscale)]
+            else:
+                level = da.coarsen(np.mean, level, dict(enumerate(downscale)), trim_excess=True).astype(level.dtype)
+            level_chunks = tuple(min(c, s) for c, s in zip(chunks, level.shape))
+            timestamp_info(f"Writing level {i} {level.shape} of {path}")
+            target = create_zarr(path / str(i), shape=level.shape, dtype=level.dtype, chunks=level_chunks,
+                                 compressor=compressor, filters=filters)
+            level.rechunk(level_chunks).store(target, lock=False)
+            # the next level is computed from the written one
+            level = da.from_zarr(target)
+    with open(path / "pyramid.json", "w") as f:
+        json.dump(dict(downscale=list(downscale), n_levels=i + 1, labels=labels), f)
+    timestamp_info(f"Pyramid of {i + 1} levels written in {path}")
+    return path
+
+def load_pyramid(fpath, chunks=None):
+    """
+    Return the levels of the multiscale pyramid of an image (full resolution first), as dask arrays,
+    or None if the pyramid was not built (see build_pyramid).
+    """
+    path = pyramid_path(fpath)
+    if not (path / "pyramid.json").exists():
+        return None
+    with open(path / "pyramid.json") as f:
+        n_levels = json.load(f)["n_levels"]
+    levels = [load_img(fpath, chunks=chunks)]
+    levels += [da.from_zarr(zarr.open_array(str(path / str(i)), mode="r")) for i in range(1, n_levels)]
+    return levels
+
+def slice_pyramid(levels, slicing):
+    """
+    Apply a slicing of the full-resolution level to all levels of a pyramid (scaled by their downsampling factor).
     """
-    np.save(path, img.swapaxes(0,2))
+    full_shape = np.array(levels[0].shape)
+    sliced = []
+    for level in levels:
+        factors = full_shape / np.array(level.shape)
+        level_slicing = tuple(slice(None if s.start is None else int(s.start // f),
+                                    None if s.stop is None else int(-(-s.stop // f)))
+                              for s, f in zip(slicing, factors))
+        sliced.append(level[level_slicing])
+    return sliced
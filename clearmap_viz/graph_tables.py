@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains array utils to build the vertex, edge and edge geometry tables of a graph.
+It only depends on numpy and pandas, so that it can be used without ClearMap.
+The tables themselves are LazyTable objects: their columns are only computed when they are accessed.
+"""
+
+
+import numpy as np
+import pandas as pd
+
+
+def edge_index_from_geometry_indices(geometry_indices, n_points):
+    """
+    Return, for each edge geometry point, the index of the edge it belongs to (-1 if none).
+    The array is built in a single vectorized pass (run-length expansion of the edge indices).
+    input:
+        geometry_indices: (n_edges, 2) array of [start, stop) indices in the edge geometry arrays
+            (as returned by ClearMap's graph.edge_geometry_indices())
+        n_points: int - total number of edge geometry points
+    returns: (n_points,) int64 array
+    """
+    geometry_indices = np.asarray(geometry_indices, dtype=np.int64).reshape(-1, 2)
+    positions, edge_ids = ranges_to_indices(geometry_indices[:, 0], geometry_indices[:, 1])
+    edge_index = np.full(n_points, -1, dtype=np.int64)
+    edge_index[positions] = edge_ids
+    return edge_index
+
+def ranges_to_indices(starts, stops):
+    """
+    Return the concatenation of the ranges [start, stop) and, for each index, the rank of its range.
+    example
+        input: np.array([0, 10]), np.array([3, 12])
+        output: np.array([0, 1, 2, 10, 11]), np.array([0, 0, 0, 1, 1])
+    """
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+    lengths = np.clip(stops - starts, 0, None)
+    range_ids = np.repeat(np.arange(len(lengths)), lengths)
+    run_starts = np.cumsum(lengths) - lengths
+    indices = np.arange(len(range_ids)) - np.repeat(run_starts - starts, lengths)
+    return indices, range_ids
+
+def vertex_edge_adjacency(connectivity, n_vertices):
+    """
+    Return the vertex -> edge adjacency in CSR format.
+    The edges connected to vertex v are indices[offsets[v]:offsets[v+1]] (a self-loop is listed twice).
+    input:
+        connectivity: (n_edges, 2) array of starting and ending vertices
+        n_vertices: int - number of vertices
+    returns: offsets (n_vertices+1,) int64 array, indices (2*n_edges,) int64 array
+    """
+    connectivity = np.asarray(connectivity).reshape(-1, 2)
+    vertices = connectivity.ravel(order="F")
+    edges = np.tile(np.arange(len(connectivity), dtype=np.int64), 2)
+    order = np.argsort(vertices, kind="stable")
+    offsets = np.zeros(n_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(vertices, minlength=n_vertices), out=offsets[1:])
+    return offsets, edges[order]
+
+def compact_array(values, downcast=False):
+    """
+    Return values as a numpy array with a native dtype.
+    If downcast is True, 64-bit integers are cast to int32 (when their range allows it) and floats to float32.
+    """
+    values = np.asarray(values)
+    if not downcast:
+        return values
+    if values.dtype.kind == "f" and values.dtype.itemsize > 4:
+        return values.astype(np.float32)
+    if values.dtype.kind in "iu" and values.dtype.itemsize > 4 and values.size > 0:
+        if np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+            return values.astype(np.int32)
+    return values
+
+def property_columns(name, values, downcast=False):
+    """
+    Return a dict of columns for a vertex or edge property.
+    Multi-dimensional properties (e.g. coordinates) are split into one column per component: name_0, name_1...
+    """
+    values = compact_array(values, downcast=downcast)
+    if values.ndim == 1:
+        return {name: values}
+    values = values.reshape(len(values), -1)
+    return {f"{name}_{i}": values[:, i] for i in range(values.shape[1])}
+
+
+class LazyTable:
+    """
+    A table whose columns are computed on first access and cached as numpy arrays.
+    Columns are registered with the function that computes them. Columns computed together
+    (e.g. x, y, z) are registered with a single function returning a (n_rows, n_columns) array.
+    Indexing with a column name returns a pandas Series, indexing with a list of names returns a DataFrame.
+    A table can be a view of the rows `index` of a parent table (see LazyTable.view): the columns that
+    are neither registered nor set in the view are gathered from the parent on first access.
+    Examples:
+        table = LazyTable()
+        table.register(["x", "y", "z"], graph.vertex_coordinates)
+        table["x"]         # computes x, y and z, returns x
+        table["norm"] = np.linalg.norm(table[["x", "y", "z"]], axis=1)
+    """
+    def __init__(self, parent=None, index=None):
+        self._computers = {}
+        self._cache = {}
+        self.parent = parent
+        self.index = index
+
+    def view(self, index):
+        """
+        Return a LazyTable of the rows `index` of this table, gathering the columns on first access.
+        """
+        return LazyTable(parent=self, index=np.asarray(index))
+
+    def register(self, names, func):
+        """
+        Register the function computing one column (str) or several columns (list of str).
+        A previously cached value of these columns is dropped.
+        """
+        names = [names] if isinstance(names, str) else list(names)
+        for name in names:
+            self._computers[name] = (names, func)
+            self._cache.pop(name, None)
+
+    def array(self, name):
+        """
+        Return a column as a numpy array, computing it if needed.
+        """
+        if name not in self._cache:
+            if name not in self._computers:
+                if self.parent is None or name not in self.parent:
+                    raise KeyError(name)
+                self._cache[name] = self.parent.array(name)[self.index]
+                return self._cache[name]
+            names, func = self._computers[name]
+            values = np.asarray(func())
+            if len(names) == 1:
+                self._cache[name] = values
+            else:
+                for i, name_i in enumerate(names):
+                    self._cache[name_i] = values[:, i]
+        return self._cache[name]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            values = self.array(key)
+            if values.ndim == 1:
+                return pd.Series(values, name=key, copy=False)
+            return pd.DataFrame(property_columns(key, values))
+        return self.to_pandas(columns=key)
+
+    def __setitem__(self, key, values):
+        if isinstance(key, str):
+            self._cache[key] = np.asarray(values)
+        else:
+            values = np.asarray(values)
+            for i, name in enumerate(key):
+                self._cache[name] = values[:, i]
+
+    def __contains__(self, name):
+        return name in self._cache or name in self._computers or (self.parent is not None and name in self.parent)
+
+    def __len__(self):
+        if self.index is not None:
+            return len(self.index)
+        if not self.columns:
+            return 0
+        return len(self.array(self.cached_columns[0] if self.cached_columns else self.columns[0]))
+
+    def __repr__(self):
+        return f"LazyTable({len(self.cached_columns)}/{len(self.columns)} columns computed: {self.cached_columns})"
+
+    @property
+    def columns(self):
+        """
+        Names of all the columns (computed or not).
+        """
+        parent_columns = self.parent.columns if self.parent is not None else []
+        return list(dict.fromkeys(parent_columns + list(self._computers) + list(self._cache)))
+
+    @property
+    def cached_columns(self):
+        """
+        Names of the columns already computed.
+        """
+        return [name for name in self.columns if name in self._cache]
+
+    def clear(self, names=None):
+        """
+        Drop the cached values of some columns (all by default). Registered columns will be computed again on access.
+        """
+        for name in (self.columns if names is None else names):
+            if name in self._computers or (self.parent is not None and name in self.parent):
+                self._cache.pop(name, None)
+
+    def compute(self, columns=None):
+        """
+        Compute some columns (all by default) and return the table.
+        """
+        for name in (self.columns if columns is None else columns):
+            self.array(name)
+        return self
+
+    def to_pandas(self, columns=None):
+        """
+        Return a pandas DataFrame with some columns (all by default).
+        Multi-dimensional columns are split into name_0, name_1...
+        """
+        data = {}
+        for name in (self.columns if columns is None else columns):
+            data.update(property_columns(name, self.array(name)))
+        return pd.DataFrame(data, copy=False)
+
+
+#########################################################
+### Transfer of properties between vertices and edges ###
+#########################################################
+
+VERTEX_TO_EDGE_METHODS = ("starting_vertex", "ending_vertex", "mean", "min", "max", "sum")
+EDGE_TO_VERTEX_METHODS = ("sum", "mean", "min", "max", "count", "mode")
+
+def sum_dtype(dtype):
+    """
+    Return the dtype in which values of a dtype are summed: int64 for booleans and integers
+    (a sum of bool is not a logical or, a sum of uint8 does not overflow), float64 for floats.
+    """
+    return np.result_type(dtype, np.int64)
+
+def vertex_to_edge_values(values, starting_vertex, ending_vertex, method="starting_vertex"):
+    """
+    Return the values of the edges computed from the values of their two vertices.
+    values: (n_vertices,) or (n_vertices, n_properties) array
+    method: one of VERTEX_TO_EDGE_METHODS
+    returns: (n_edges,) or (n_edges, n_properties) array
+    """
+    values = np.asarray(values)
+    if method == "starting_vertex":
+        return values[starting_vertex]
+    elif method == "ending_vertex":
+        return values[ending_vertex]
+    starting_values, ending_values = values[starting_vertex], values[ending_vertex]
+    if method == "mean":
+        return (starting_values.astype(np.float64) + ending_values) / 2
+    elif method == "min":
+        return np.minimum(starting_values, ending_values)
+    elif method == "max":
+        return np.maximum(starting_values, ending_values)
+    elif method == "sum":
+        return starting_values.astype(sum_dtype(values.dtype)) + ending_values
+    raise ValueError(f"method {method} not recognized")
+
+def edge_to_vertex_values(values, offsets, indices, method="mean", fill_value=np.nan):
+    """
+    Return the values of the vertices aggregated from the values of their connected edges.
+    values: (n_edges,) or (n_edges, n_properties) array
+    offsets, indices: vertex -> edges adjacency in CSR format (see vertex_edge_adjacency)
+    method: one of EDGE_TO_VERTEX_METHODS ("mode" is the most frequent value, e.g. for atlas labels; ties go to the smallest)
+    fill_value: value of the vertices without edges (for mean, min, max and mode)
+    returns: (n_vertices,) or (n_vertices, n_properties) array
+    """
+    values = np.asarray(values)
+    counts = np.diff(offsets)
+    if method == "count":
+        return counts
+    slot_values = values[indices]
+    if method == "mode":
+        return _mode_by_segment(slot_values, counts, fill_value)
+    has_edges = counts > 0
+    # reduceat needs non-empty segments: reduce over the vertices with edges only
+    starts = offsets[:-1][has_edges]
+    if method in ("sum", "mean"):
+        dtype = np.float64 if method == "mean" else sum_dtype(values.dtype)
+        result = np.zeros((len(counts),) + values.shape[1:], dtype=dtype)
+        if len(starts):
+            result[has_edges] = np.add.reduceat(slot_values, starts, axis=0, dtype=dtype)
+        if method == "mean":
+            result[has_edges] /= counts[has_edges].reshape((-1,) + (1,) * (values.ndim - 1))
+            result[~has_edges] = fill_value
+        return result
+    if method in ("min", "max"):
+        result = np.full((len(counts),) + values.shape[1:], fill_value, dtype=np.result_type(values.dtype, np.asarray(fill_value).dtype))
+        if len(starts):
+            result[has_edges] = (np.minimum if method == "min" else np.maximum).reduceat(slot_values, starts, axis=0)
+        return result
+    raise ValueError(f"method {method} not recognized")
+
+def _mode_by_segment(slot_values, counts, fill_value):
+    """
+    Return the most frequent value of each segment of slot_values (segments of lengths counts).
+    """
+    if slot_values.ndim > 1:
+        return np.stack([_mode_by_segment(slot_values[:, i], counts, fill_value) for i in range(slot_values.shape[1])], axis=1)
+    segment_ids = np.repeat(np.arange(len(counts)), counts)
+    result = np.full(len(counts), fill_value, dtype=np.result_type(slot_values.dtype, np.asarray(fill_value).dtype))
+    if len(slot_values) == 0:
+        return result
+    # count each (segment, value) pair, then keep the most frequent value of each segment
+    order = np.lexsort((slot_values, segment_ids))
+    segment_ids, slot_values = segment_ids[order], slot_values[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (segment_ids[1:] != segment_ids[:-1]) | (slot_values[1:] != slot_values[:-1])
+    pair_starts = np.flatnonzero(is_new)
+    pair_counts = np.diff(np.append(pair_starts, len(order)))
+    pair_segments, pair_values = segment_ids[pair_starts], slot_values[pair_starts]
+    best = np.lexsort((pair_values, -pair_counts, pair_segments))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = pair_segments[best][1:] != pair_segments[best][:-1]
+    result[pair_segments[best][first]] = pair_values[best][first]
+    return result
+
+def statistics_by_label(labels, values=None, statistics=("count", "sum", "mean")):
+    """
+    Return a dataframe of statistics of values grouped by integer labels (one row per label present, sorted).
+    The labels are mapped to dense indices (np.unique), then counted with np.bincount: one pass over the data
+    whatever the number of labels, and arrays of the number of labels present, not of the largest label
+    (atlas ids go up to 614454277).
+    labels: (n,) int array (e.g. atlas region of each edge)
+    values: dict of name -> (n,) arrays (e.g. {"length": ..., "radius": ...})
+    statistics: subset of ("count", "sum", "mean", "std")
+    """
+    present, inverse = np.unique(np.asarray(labels).astype(np.int64, copy=False), return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(present))
+    data = {"label": present}
+    if "count" in statistics:
+        data["count"] = counts
+    for name, value in (values or {}).items():
+        value = np.asarray(value, dtype=np.float64)
+        sums = np.bincount(inverse, weights=value, minlength=len(present))
+        means = sums / counts
+        if "sum" in statistics:
+            data[f"{name}_sum"] = sums
+        if "mean" in statistics:
+            data[f"{name}_mean"] = means
+        if "std" in statistics:
+            squares = np.bincount(inverse, weights=value ** 2, minlength=len(present))
+            data[f"{name}_std"] = np.sqrt(np.clip(squares / counts - means ** 2, 0, None))
+    return pd.DataFrame(data)
@@ -1,9 +1,13 @@
 from .params import LOCAL_CLEARMAP
-from .utils import timestamp_error, timestamp_info, timestamp_ok, timestamp_warning
+from .utils import timestamp_info, timestamp_ok, timestamp_warning
 import sys
-from pathlib import Path
-import pandas as pd
-from .graph_viz import plot_components, plot_radii, plot_components, plot_radii, plot_degrees, plot_edge_value
+import weakref
+import numpy as np
+from .cache import get_cache_entry, save_table, load_table, evict_cache
+from .graph_tables import edge_index_from_geometry_indices, vertex_edge_adjacency, compact_array, ranges_to_indices, LazyTable
+from .sketch import ColumnSummary
+from .spatial import load_spatial_index
+from .graph_viz import plot_components, plot_radii, plot_components, plot_radii, plot_degrees, plot_edge_value, plot_summary
 
 try:
     import ClearMap.Analysis.Graphs.GraphGt as ggt
@@ -19,82 +23,353 @@ except ImportError:
         load_graph = None
 
 
-def load_graph(fpath):
+# edge property holding the root edge indices while a GraphView builds its ClearMap subgraph
+ROOT_EDGE_INDEX = "root_edge_index"
+
+def load_graph(fpath, cache=True):
     """
     Load a graph from a file.
+    If cache is True, the columns of the dataframes saved with Graph.save_cache are read from the on-disk cache
+    instead of being computed (see clearmap_viz.cache).
+    Note: the computed columns are not saved automatically: call graph.save_cache() once they are computed
+    (or save_cache(compute=True)), otherwise the next load_graph computes them again.
+    Examples:
+        graph = load_graph(fpath)
+        graph.save_cache(compute=True)  # first session
+        graph = load_graph(fpath)  # later sessions: the columns are read from the cache
     """
     fpath = str(fpath)
     g = ggt.load(fpath)
-    return Graph(g)
+    return Graph(g, source_path=fpath if cache else None)
+
+
+def register_edge_topology(v_df, e_df):
+    """
+    Register in e_df the columns derived from the connectivity (starting_vertex, ending_vertex)
+    and from the vertex columns (x, y, z, degree, component): endpoint coordinates and degrees, topology flags.
+    """
+    starting_vertex = lambda: e_df.array("starting_vertex")
+    ending_vertex = lambda: e_df.array("ending_vertex")
+    e_df.register("component", lambda: v_df.array("component")[starting_vertex()])
+    e_df.register("starting_degree", lambda: v_df.array("degree")[starting_vertex()])
+    e_df.register("ending_degree", lambda: v_df.array("degree")[ending_vertex()])
+    e_df.register(["starting_x", "starting_y", "starting_z"],
+                  lambda: np.stack([v_df.array(c)[starting_vertex()] for c in "xyz"], axis=1))
+    e_df.register(["ending_x", "ending_y", "ending_z"],
+                  lambda: np.stack([v_df.array(c)[ending_vertex()] for c in "xyz"], axis=1))
+    e_df.register("has_degree_2", lambda: (e_df.array("starting_degree") == 2) | (e_df.array("ending_degree") == 2))
+    e_df.register("min_degree", lambda: np.minimum(e_df.array("starting_degree"), e_df.array("ending_degree")))
+    e_df.register("is_self_loop", lambda: starting_vertex() == ending_vertex())
+
+
+class GraphBase:
+    """
+    Methods shared by Graph and GraphView: adjacency, subgraph views and plots.
+    Subclasses define v_df, e_df, eg_df (LazyTable), n_vertices, n_edges and graph (the ClearMap graph).
+    """
+    def adjacency(self):
+        """
+        Return the vertex -> edges adjacency in CSR format (offsets, indices), computed once.
+        """
+        if self._adjacency is None:
+            connectivity = np.stack([self.e_df.array("starting_vertex"), self.e_df.array("ending_vertex")], axis=1)
+            self._adjacency = vertex_edge_adjacency(connectivity, self.n_vertices)
+        return self._adjacency
+
+    def connected_edges(self, vertex_index):
+        """
+        Return the indices of the edges connected to a vertex.
+        """
+        offsets, indices = self.adjacency()
+        return indices[offsets[vertex_index]:offsets[vertex_index + 1]]
 
+    def view(self, vertex_filter=None, edge_filter=None):
+        """
+        Return a GraphView of a subset of the vertices and/or edges (boolean masks or arrays of indices).
+        Only the edges whose both vertices are selected are kept.
+        """
+        if vertex_filter is None:
+            vertex_indices = np.arange(self.n_vertices)
+        else:
+            vertex_indices = np.asarray(vertex_filter)
+            vertex_indices = np.flatnonzero(vertex_indices) if vertex_indices.dtype == bool else np.unique(vertex_indices)
+        vertex_mask = np.zeros(self.n_vertices, dtype=bool)
+        vertex_mask[vertex_indices] = True
+        edge_mask = vertex_mask[self.e_df.array("starting_vertex")] & vertex_mask[self.e_df.array("ending_vertex")]
+        if edge_filter is not None:
+            edge_filter = np.asarray(edge_filter)
+            if edge_filter.dtype != bool:
+                edge_filter = np.isin(np.arange(self.n_edges), edge_filter)
+            edge_mask &= edge_filter
+        edge_indices = np.flatnonzero(edge_mask)
+        if isinstance(self, GraphView):
+            return GraphView(self.root, self.vertex_indices[vertex_indices], self.edge_indices[edge_indices])
+        return GraphView(self, vertex_indices, edge_indices)
 
-class Graph(ggt.Graph):
-    def __init__(self, ggt_graph):
-        self.__dict__ = ggt_graph.__dict__.copy()
+    def edge_view(self, edge_filter):
+        """
+        Return a GraphView of a subset of the edges (boolean mask or array of indices) and of their vertices only.
+        """
+        edge_indices = np.asarray(edge_filter)
+        edge_indices = np.flatnonzero(edge_indices) if edge_indices.dtype == bool else np.unique(edge_indices)
+        vertex_indices = np.unique(np.concatenate([self.e_df.array("starting_vertex")[edge_indices],
+                                                   self.e_df.array("ending_vertex")[edge_indices]]))
+        if isinstance(self, GraphView):
+            return GraphView(self.root, self.vertex_indices[vertex_indices], self.edge_indices[edge_indices])
+        return GraphView(self, vertex_indices, edge_indices)
 
-    def compute_dfs(self, with_eg_df=False):
+    def component_view(self, components):
         """
-        Return a dataframe of vertices and a dataframe of edges
+        Return a GraphView of one or several connected components (labels of v_df["component"]).
         """
+        return self.view(vertex_filter=np.isin(self.v_df.array("component"), components))
 
-        # creates a vertex dataframe
-        self.v_df = pd.DataFrame()
-        self.v_df[["x", "y", "z"]] = self.vertex_coordinates()
-        self.v_df["degree"] = self.vertex_degrees()
-        self.v_df["component"] = self.label_components()
+    def region_view(self, labels, column="annotation"):
+        """
+        Return a GraphView of the vertices whose v_df[column] is in labels (e.g. atlas regions, see annotate_graph).
+        """
+        return self.view(vertex_filter=np.isin(self.v_df.array(column), labels))
 
+    def spatial_index(self, kind="vertices"):
+        """
+        Return the spatial index (see spatial.GridIndex) of the vertices or of the edge geometry points, built once.
+        The index of a graph loaded with cache=True is cached on disk with the other tables of the graph file.
+        kind: "vertices" or "edge_geometry"
+        """
+        if kind not in self._spatial_indices:
+            table = {"vertices": self.v_df, "edge_geometry": self.eg_df}[kind]
+            coordinates = lambda: np.stack([table.array(c) for c in "xyz"], axis=1)
+            source_path = None if isinstance(self, GraphView) else self.source_path
+            self._spatial_indices[kind] = load_spatial_index(coordinates, source_path=source_path, name=kind)
+        return self._spatial_indices[kind]
 
-        # creates an edge dataframe
-        self.e_df = pd.DataFrame()
-        self.e_df[["starting_vertex", "ending_vertex"]] = self.edge_connectivity()
-        self.e_df["component"] = self.v_df.loc[self.e_df["starting_vertex"], "component"].values
-        self.e_df["starting_degree"] = self.v_df.loc[self.e_df["starting_vertex"], "degree"].values
-        self.e_df["ending_degree"] = self.v_df.loc[self.e_df["ending_vertex"], "degree"].values
-        self.e_df[["starting_x", "starting_y", "starting_z"]] = self.v_df.loc[self.e_df["starting_vertex"], ["x", "y", "z"]].values
-        self.e_df[["ending_x", "ending_y", "ending_z"]] = self.v_df.loc[self.e_df["ending_vertex"], ["x", "y", "z"]].values
+    def column_summary(self, column, table="e_df", n_bins=100):
+        """
+        Return the statistics of a column (see sketch.ColumnSummary: histograms, min/max, quantiles), computed once
+        and kept with the graph; they are computed again if the column is recomputed or set.
+        table: "v_df", "e_df" or "eg_df"
+        """
+        values = getattr(self, table).array(column)
+        key = (table, column, n_bins)
+        if key not in self._column_summaries or self._column_summaries[key][0]() is not values:
+            self._column_summaries[key] = (weakref.ref(values), ColumnSummary.from_array(values, n_bins=n_bins))
+        return self._column_summaries[key][1]
 
-        # creates an edge_geometry dataframe
-        if with_eg_df:
-            self.eg_df = pd.DataFrame(self.graph_property("edge_geometry_coordinates"), columns=["x", "y", "z"])
-            self.eg_df["radii"] = self.graph_property("edge_geometry_radii")
-            self.eg_df["edge_index"] = -1
-            # this takes time
-            for i, (start, finish) in enumerate(self.edge_geometry_indices().tolist()):
-                self.eg_df.loc[start:finish, "edge_index"] = i
+    def bbox_view(self, slicing):
+        """
+        Return a GraphView of the vertices within a bounding box (queried with the spatial index of the vertices).
+        slicing: tuple of 3 slices in the x, y, z order of the graph coordinates
+            (see convert_center_to_slicing, with reverse_order=True for napari coordinates)
+        """
+        return self.view(vertex_filter=self.spatial_index("vertices").query_slicing(slicing))
 
-        # adds edge_properties
-        self.e_df["radius"] = self.edge_property("radii")
-        self.e_df["length"] = self.edge_property("length")
+    def radius_view(self, center, radius):
+        """
+        Return a GraphView of the vertices within a distance of a center (x, y, z), e.g. around a clicked point.
+        """
+        return self.view(vertex_filter=self.spatial_index("vertices").radius(center, radius))
 
+    def plot_radii(self, **kwargs):
+        return plot_radii(self, **kwargs)
 
-        # adds topology properties of the edges
-        self.e_df["has_degree_2"] = (self.e_df[["starting_degree", "ending_degree"]] == 2).any(axis=1)
-        self.e_df["min_degree"] = self.e_df[["starting_degree", "ending_degree"]].min(axis=1)
-        self.e_df["is_self_loop"] = self.e_df["starting_vertex"] == self.e_df["ending_vertex"]
+    def plot_components(self, **kwargs):
+        return plot_components(self, **kwargs)
 
-        # adds connected_edges to df vertices
-        df_vertex_connectivity = pd.concat([self.e_df["starting_vertex"], self.e_df["ending_vertex"]], axis=0).to_frame(name="vertex_index").reset_index(names="edge_index")
-        self.v_df = self.v_df.join(df_vertex_connectivity.groupby("vertex_index").agg(list).rename(columns={"edge_index": "connected_edges"}))
+    def plot_degrees(self, **kwargs):
+        return plot_degrees(self, **kwargs)
 
+    def plot_edge_value(self, *args, **kwargs):
+        return plot_edge_value(self, *args, **kwargs)
 
+    def plot_distribution(self, column, table="e_df", log=False):
+        return plot_summary(self.column_summary(column, table=table), variable_name=column, log=log)
 
 
+class Graph(GraphBase):
+    """
+    Wrapper around a ClearMap graph with lazy dataframes of vertices (v_df), edges (e_df) and edge geometry points (eg_df).
+    The ClearMap graph is not copied: it is available as graph.graph, and its attributes and methods
+    are accessible from the wrapper (e.g. graph.n_edges, graph.vertex_coordinates()).
+    """
+    def __init__(self, ggt_graph, source_path=None):
+        self.graph = ggt_graph
+        self.source_path = source_path
+        self.compute_dfs()
+
+    def __getattr__(self, name):
+        # only called for attributes not defined by the wrapper
+        if name == "graph":
+            raise AttributeError(name)
+        return getattr(self.graph, name)
+
+    def compute_dfs(self, with_eg_df=False, downcast=False, eager=False):
+        """
+        Set up the dataframes of vertices (v_df), edges (e_df) and edge geometry points (eg_df).
+        The dataframes are LazyTable objects: each column is computed on first access and cached,
+        so that e.g. plot_radii only computes the edge radii.
+        All columns have native numpy dtypes. If downcast is True, int64/float64 columns are stored as int32/float32.
+        If eager is True, all the columns of v_df and e_df (and of eg_df if with_eg_df is True) are computed right away.
+        """
+        compact = lambda values: compact_array(values, downcast=downcast)
+        self.v_df, self.e_df, self.eg_df = LazyTable(), LazyTable(), LazyTable()
+        self._adjacency = None
+        self._spatial_indices = {}
+        self._column_summaries = {}
+        v_df, e_df, eg_df = self.v_df, self.e_df, self.eg_df
+
+        # vertex dataframe
+        v_df.register(["x", "y", "z"], lambda: compact(self.vertex_coordinates()))
+        v_df.register("degree", lambda: compact(self.vertex_degrees()))
+        v_df.register("component", lambda: compact(self.label_components()))
+
+        # edge dataframe
+        e_df.register(["starting_vertex", "ending_vertex"], lambda: compact(self.edge_connectivity()))
+        register_edge_topology(v_df, e_df)
+
+        # edge_geometry dataframe
+        eg_df.register(["x", "y", "z"], lambda: compact(self.graph_property("edge_geometry_coordinates")))
+        eg_df.register("radii", lambda: compact(self.graph_property("edge_geometry_radii")))
+        eg_df.register("edge_index", lambda: compact(edge_index_from_geometry_indices(self.edge_geometry_indices(), len(eg_df.array("radii")))))
+
+        # edge_properties
+        e_df.register("radius", lambda: compact(self.edge_property("radii")))
+        e_df.register("length", lambda: compact(self.edge_property("length")))
+
         for prop in self.vertex_properties:
-            self.v_df["vp_" + prop] = list(self.vertex_property(prop))
+            v_df.register("vp_" + prop, lambda prop=prop: compact(self.vertex_property(prop)))
 
         for prop in self.edge_properties:
-            self.e_df["ep_" + prop] = list(self.edge_property(prop))
+            e_df.register("ep_" + prop, lambda prop=prop: compact(self.edge_property(prop)))
+
+        # columns already in the on-disk cache are read instead of computed
+        entry = get_cache_entry(self.source_path, create=False) if self.source_path is not None else None
+        if entry is not None:
+            for name, table in [("v_df", v_df), ("e_df", e_df), ("eg_df", eg_df)]:
+                load_table(entry, name, table, transform=compact)
 
+        if eager:
+            v_df.compute()
+            e_df.compute()
+            if with_eg_df:
+                eg_df.compute()
         return self
 
-    def plot_radii(self):
-        return plot_radii(self)
+    def save_cache(self, compute=False):
+        """
+        Save the computed columns of v_df, e_df and eg_df to the on-disk cache of the graph file,
+        then evict the least recently used cache entries if the cache is too large.
+        If compute is True, all the columns of v_df and e_df are computed first.
+        """
+        if self.source_path is None:
+            raise ValueError("The graph has no source file: load it with load_graph(fpath, cache=True).")
+        if compute:
+            self.v_df.compute()
+            self.e_df.compute()
+        entry = get_cache_entry(self.source_path)
+        for name, table in [("v_df", self.v_df), ("e_df", self.e_df), ("eg_df", self.eg_df)]:
+            save_table(entry, name, table)
+        evict_cache()
+        timestamp_ok(f"Graph tables cached in {entry}")
+        return self
 
-    def plot_components(self):
-        return plot_components(self)
 
-    def plot_degrees(self):
-        return plot_degrees(self)
+class GraphView(GraphBase):
+    """
+    Subgraph of a Graph defined by the indices of its vertices and edges in the root graph.
+    Its dataframes gather their columns from the root dataframes on first access (LazyTable.view):
+    no graph is loaded and no column is copied until it is used.
+    Vertex and edge indices are local to the view; starting_vertex/ending_vertex are remapped accordingly,
+    and degrees are those of the subgraph. The ClearMap subgraph (view.graph) is only built when needed, e.g. for rendering.
+    Examples:
+        view = graph.component_view(0)
+        view = graph.bbox_view(convert_center_to_slicing(center_xyz, (500, 500, 500)))
+        view.plot_radii()
+    """
+    def __init__(self, root, vertex_indices, edge_indices):
+        self.root = root
+        self.vertex_indices = np.asarray(vertex_indices)
+        self.edge_indices = np.asarray(edge_indices)
+        self._graph = None
+        self._graph_edge_indices = None
+        self._adjacency = None
+        self._spatial_indices = {}
+        self._column_summaries = {}
+        self.v_df = root.v_df.view(self.vertex_indices)
+        self.e_df = root.e_df.view(self.edge_indices)
+        v_df, e_df = self.v_df, self.e_df
 
-    def plot_edge_value(self, *args, **kwargs):
-        return plot_edge_value(self, *args, **kwargs)
+        # local connectivity and degrees
+        local_vertex = lambda name: np.searchsorted(self.vertex_indices, root.e_df.array(name)[self.edge_indices])
+        e_df.register(["starting_vertex", "ending_vertex"],
+                      lambda: np.stack([local_vertex("starting_vertex"), local_vertex("ending_vertex")], axis=1))
+        v_df.register("degree", lambda: np.bincount(np.concatenate([e_df.array("starting_vertex"), e_df.array("ending_vertex")]),
+                                                    minlength=self.n_vertices))
+        register_edge_topology(v_df, e_df)
+
+        # edge geometry points of the selected edges
+        self._point_indices = None
+        self.eg_df = LazyTable()
+        self.eg_df.register(["x", "y", "z"], lambda: np.stack([root.eg_df.array(c)[self.point_indices()[0]] for c in "xyz"], axis=1))
+        self.eg_df.register("radii", lambda: root.eg_df.array("radii")[self.point_indices()[0]])
+        self.eg_df.register("edge_index", lambda: self.point_indices()[1])
+
+    def __repr__(self):
+        return f"GraphView({self.n_vertices} vertices, {self.n_edges} edges)"
+
+    @property
+    def n_vertices(self):
+        return len(self.vertex_indices)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_indices)
+
+    def point_indices(self):
+        """
+        Return the indices of the edge geometry points of the view in the root graph, and their (local) edge index.
+        """
+        if self._point_indices is None:
+            geometry_indices = np.asarray(self.root.edge_geometry_indices())[self.edge_indices]
+            self._point_indices = ranges_to_indices(geometry_indices[:, 0], geometry_indices[:, 1])
+        return self._point_indices
+
+    @property
+    def graph(self):
+        """
+        ClearMap subgraph of the view, built on first access.
+        """
+        if self._graph is None:
+            vertex_filter = np.zeros(self.root.n_vertices, dtype=bool)
+            vertex_filter[self.vertex_indices] = True
+            edge_filter = np.zeros(self.root.n_edges, dtype=bool)
+            edge_filter[self.edge_indices] = True
+            # graph-tool numbers the edges of the subgraph in its own order: the root edge indices are carried
+            # by a temporary edge property of the root graph, copied to the subgraph (see graph_edge_indices)
+            root_graph = self.root.graph
+            root_graph.add_edge_property(ROOT_EDGE_INDEX, np.arange(self.root.n_edges))
+            try:
+                self._graph = root_graph.sub_graph(vertex_filter=vertex_filter, edge_filter=edge_filter)
+            finally:
+                root_graph.remove_edge_property(ROOT_EDGE_INDEX)
+            root_edge_index = np.asarray(self._graph.edge_property(ROOT_EDGE_INDEX)).astype(np.int64)
+            if not np.array_equal(np.sort(root_edge_index), self.edge_indices):
+                raise RuntimeError("The edges of the ClearMap subgraph are not the edges of the view.")
+            # the edge indices of the view are sorted
+            self._graph_edge_indices = np.searchsorted(self.edge_indices, root_edge_index)
+        return self._graph
+
+    def graph_edge_indices(self):
+        """
+        Return the index in the view of each edge of the ClearMap subgraph (view.graph), in the order of the subgraph.
+        """
+        _ = self.graph  # builds the subgraph and its edge indices
+        return self._graph_edge_indices
+
+    def __getattr__(self, name):
+        # only called for attributes not defined by the view: they are those of the ClearMap subgraph
+        if name in ("root", "_graph", "_graph_edge_indices", "_point_indices"):
+            raise AttributeError(name)
+        # the subgraph is only built for attributes of ClearMap graphs: a typo or hasattr(view, name) does not build it
+        if not hasattr(self.root.graph, name):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        return getattr(self.graph, name)
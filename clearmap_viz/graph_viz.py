@@ -6,12 +6,16 @@ except ImportError:
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import seaborn as sns
 import graph_tool.all as gt
 from pathlib import Path
+import weakref
 
-from .data import load_img
-from .utils import timestamp_error, timestamp_info, timestamp_ok, timestamp_warning
+from .cache import get_cache_entry, save_arrays, load_arrays, evict_cache
+from .data import load_img, sample_volume, compact_labels
+from .graph_tables import vertex_to_edge_values, edge_to_vertex_values, statistics_by_label, ranges_to_indices
+from .meshing import TubeMesh, LineMesh, encode_edge_ids, decode_edge_ids, group_by_edge, spatial_chunks
+from .sketch import QuantileSketch, ColumnSummary
+from .utils import timestamp_info, timestamp_warning
 from .params import LOCAL_CLEARMAP
 # from .graph_utils import Graph
 
@@ -29,6 +33,10 @@ except ImportError:
         timestamp_warning(f"Could not import ClearMap. Make sure it is installed and accessible from the current environment. {e}")
         load_graph = None
 
+# tube meshes of the graphs, cached per graph and meshing parameters (see get_tube_mesh)
+_TUBE_MESHES = weakref.WeakKeyDictionary()
+# level-of-detail meshes of the graphs, cached per graph and parameters (see get_lod_meshes)
+_LOD_MESHES = weakref.WeakKeyDictionary()
 
 def make_rainbow_array(n_colors):
     """
@@ -41,119 +49,370 @@ def make_rainbow_array(n_colors):
     """
     return hsv_to_rgb(np.array([np.linspace(0,1,n_colors, endpoint=False)] + 2*[np.ones(n_colors)]).T)
 
-def digitize_bins(variable, n_bins, plot=True):
+def digitize_bins(variable, n_bins, plot=False, summary=None, chunk_size=10**7):
     """
     Return a vector of same size as variable, with values ranging from 0 to n_bins-1
-    All values are equally
+    All values are equally distributed among the bins: their limits are approximate quantiles of variable
+    (streaming sketch, see sketch.QuantileSketch), so that variable is only read chunk by chunk
+    and can be a memory-mapped or lazy column (numpy, zarr, dask...).
+        summary: ColumnSummary of variable, if already computed (e.g. graph.column_summary(column_name))
+        plot: plot the distribution of variable and the bins (from the histograms of the summary, see plot_bins)
+    The bin indices are stored with the smallest integer dtype that can hold them.
     """
-    bins = np.quantile(variable[~np.isnan(variable)], np.linspace(0,1,n_bins))
-    print(f"{len(bins)} bins with limits: ", " - ".join(map("{:.1e}".format, bins)))
-    digitized = np.digitize(variable, bins=bins)-1
+    if isinstance(variable, pd.Series):
+        variable = variable.to_numpy()
+    sketch = summary.sketch if summary is not None else QuantileSketch.from_array(variable, chunk_size=chunk_size)
+    bins = sketch.quantiles(np.linspace(0, 1, n_bins))
+    timestamp_info(f"{len(bins)} bins with limits: " + " - ".join(map("{:.1e}".format, bins)))
+    digitized = np.empty(len(variable), dtype=np.min_scalar_type(-(n_bins + 1)))
+    for start in range(0, len(variable), chunk_size):
+        digitized[start:start + chunk_size] = np.digitize(np.asarray(variable[start:start + chunk_size]), bins=bins) - 1
     if plot:
-        fig, axs = plt.subplots(1,3, figsize=(15,3))
-        axi = axs.flat
-        plt.sca(next(axi))
-        sns.histplot(variable, bins=100)
-        for bin in bins:
-            plt.axvline(bin, color="r")
+        plot_bins(summary if summary is not None else ColumnSummary(sketch), bins,
+                  bin_counts=np.bincount(np.clip(digitized, 0, None), minlength=n_bins))
+    return digitized
+
+def plot_histogram(counts, edges, log_x=False, log_y=False):
+    """
+    Plot a histogram from its counts and bin edges (e.g. ColumnSummary.linear_counts and linear_edges), in the current axes.
+    """
+    plt.stairs(counts, edges, fill=True, alpha=0.6)
+    if log_x:
+        plt.xscale("log")
+    if log_y:
+        plt.yscale("log")
+
+def plot_summary(summary, variable_name="", log=False):
+    """
+    Plot the distribution of a column from its ColumnSummary (e.g. graph.column_summary("radius")), in the current axes:
+    the counts of its values if it is discrete, else its linear (or log-log if log) histogram.
+    """
+    if summary.discrete_counts is not None:
+        plot_discrete_counts(summary.discrete_counts, variable_name=variable_name, log_y=log)
+        return
+    if log:
+        plot_histogram(summary.log_counts, summary.log_edges, log_x=True, log_y=True)
+    else:
+        plot_histogram(summary.linear_counts, summary.linear_edges)
+    plt.xlabel(variable_name)
+
+def plot_bins(summary, bins, bin_counts=None):
+    """
+    Plot the distribution of a variable (linear and log-log histograms of its ColumnSummary) with the limits of its bins,
+    and the number of values per bin (bin_counts, e.g. the bincount of digitize_bins).
+    Only the precomputed histograms are drawn: the time does not depend on the number of values.
+    """
+    fig, axs = plt.subplots(1, 3 if bin_counts is not None else 2, figsize=(15, 3))
+    axi = axs.flat
+    for counts, edges, log in [(summary.linear_counts, summary.linear_edges, False), (summary.log_counts, summary.log_edges, True)]:
         plt.sca(next(axi))
-        sns.histplot(variable, bins=100)
+        plot_histogram(counts, edges, log_x=log, log_y=log)
         for bin in bins:
             plt.axvline(bin, color="r")
-        plt.xscale("log")
-        plt.yscale("log")
+    if bin_counts is not None:
         plt.sca(next(axi))
-        plot_discrete_distribution(digitized, log_y=False)
+        plot_discrete_counts(bin_counts, log_y=False)
         plt.xlabel("Bins")
-        plt.tight_layout()
-    return digitized
+    plt.tight_layout()
+    return fig
 
-def plot_discrete_distribution(variable, variable_name="", starts_at_zero=True, log_y=True):
-    sns.histplot(variable, discrete=True)
+def plot_discrete_counts(counts, variable_name="", starts_at_zero=True, log_y=True):
+    """
+    Plot the counts of the values 0, 1, 2... of a discrete variable (e.g. np.bincount), as bars.
+    """
+    values = np.arange(len(counts))
+    plt.bar(values, counts, width=1)
     if log_y:
         plt.yscale("log")
-    plt.xticks(np.arange(1-int(starts_at_zero), variable.max()+1, step=np.floor(variable.max()//12+1)))
+    plt.xticks(np.arange(1-int(starts_at_zero), len(counts), step=np.floor((len(counts) - 1)//12+1)))
     plt.xlabel(variable_name)
 
-def plot_pyvista(g, edge_colors):
-    if g.n_edges != len(edge_colors):
-        raise ValueError(f"graph has {g.n_edges} edges, but {len(edge_colors)} colors were provided.")
-    interpolation = gr.interpolate_edge_geometry(g, smooth=5, order=2, points_per_pixel=0.2, verbose=False)
+def plot_discrete_distribution(variable, variable_name="", starts_at_zero=True, log_y=True):
+    """
+    Plot the distribution of a discrete variable: an array of non-negative integers (counted with np.bincount),
+    or its ColumnSummary (e.g. graph.column_summary("degree", table="v_df")), drawn from its precomputed counts.
+    """
+    if isinstance(variable, ColumnSummary):
+        counts = variable.discrete_counts
+        if counts is None:
+            raise ValueError("The column is not discrete (non-negative integers): use plot_summary.")
+    else:
+        variable = np.asarray(variable)
+        counts = np.bincount(variable[variable >= 0].astype(np.int64))
+    plot_discrete_counts(counts, variable_name=variable_name, starts_at_zero=starts_at_zero, log_y=log_y)
+
+def _slice_interpolation(interpolation, edge_indices):
+    """
+    Return the interpolated edge geometry of the edges edge_indices (in this order) from that of all the edges:
+    each edge is interpolated on its own, so the interpolation of a subgraph is a slice of that of the graph.
+    """
+    coordinates, radii, indices = interpolation
+    ranges = np.asarray(indices)[edge_indices]
+    point_indices = ranges_to_indices(ranges[:, 0], ranges[:, 1])[0]
+    lengths = ranges[:, 1] - ranges[:, 0]
+    stops = np.cumsum(lengths)
+    return coordinates[point_indices], radii[point_indices], np.stack([stops - lengths, stops], axis=1).astype(ranges.dtype)
+
+def _graph_edge_ids(g):
+    """
+    Return the index in g of each edge of its ClearMap graph, in the order of the ClearMap graph
+    (the edges of the subgraph of a GraphView are numbered by graph-tool: see GraphView.graph_edge_indices).
+    """
+    if "root" in getattr(g, "__dict__", {}):
+        return g.graph_edge_indices()
+    return np.arange(g.n_edges)
 
-    coordinates, faces, colors = gr.mesh_tube_from_coordinates_and_radii(*interpolation,
-                                        n_tube_points=5, edge_colors=edge_colors,
+def interpolate_edge_geometry(g, smooth=5, order=2, points_per_pixel=0.2, cache=True, return_edge_ids=False):
+    """
+    Return the interpolated edge geometry of a graph (coordinates, radii, indices: see gr.interpolate_edge_geometry).
+    If cache is True and the graph was loaded with cache=True, the arrays are saved in the cache entry of the graph file,
+    one folder per interpolation parameters: later sessions and processes memory-map them instead of interpolating again.
+    The interpolation of a GraphView of such a graph is sliced from the cached interpolation of the whole graph
+    (see _slice_interpolation): its ClearMap subgraph is not built, and nothing is cached per view.
+    return_edge_ids: also return the index in g of each interpolated edge (see _graph_edge_ids)
+    """
+    # vars: the wrappers forward unknown attributes to the ClearMap graph, which would build the subgraph of a view
+    root = getattr(g, "__dict__", {}).get("root", g)
+    source_path = getattr(root, "__dict__", {}).get("source_path") if cache else None
+    if source_path is not None and root is not g:
+        interpolation = _slice_interpolation(interpolate_edge_geometry(root, smooth=smooth, order=order,
+                                                                       points_per_pixel=points_per_pixel), g.edge_indices)
+        return (interpolation, np.arange(g.n_edges)) if return_edge_ids else interpolation
+    if source_path is not None:
+        folder = get_cache_entry(source_path) / f"edge_interpolation_{smooth:g}_{order:g}_{points_per_pixel:g}"
+        # copy-on-write: the arrays are read from the disk, and never written back
+        arrays = load_arrays(folder, mmap_mode="c")
+        if arrays is not None:
+            return (tuple(arrays), np.arange(g.n_edges)) if return_edge_ids else tuple(arrays)
+    # g can be a Graph or GraphView wrapper, or a ClearMap graph
+    interpolation = gr.interpolate_edge_geometry(getattr(g, "graph", g), smooth=smooth, order=order, points_per_pixel=points_per_pixel, verbose=False)
+    if source_path is not None:
+        save_arrays(folder, list(interpolation))
+        evict_cache()
+        timestamp_info(f"Edge geometry interpolation cached in {folder}")
+    return (interpolation, _graph_edge_ids(g)) if return_edge_ids else interpolation
+
+def build_tube_mesh(g, n_tube_points=5, smooth=5, order=2, points_per_pixel=0.2):
+    """
+    Return a new TubeMesh of a graph (interpolated edge geometry meshed as tubes), not cached (see get_tube_mesh).
+    The interpolation of the edge geometry is cached on disk (see interpolate_edge_geometry).
+    """
+    interpolation, edge_ids = interpolate_edge_geometry(g, smooth=smooth, order=order, points_per_pixel=points_per_pixel,
+                                                        return_edge_ids=True)
+    # the edge indices are meshed as colors to map each mesh point to its edge
+    coordinates, faces, point_colors = gr.mesh_tube_from_coordinates_and_radii(*interpolation,
+                                        n_tube_points=n_tube_points, edge_colors=encode_edge_ids(edge_ids),
                                         processes=None, verbose=False)
+    return TubeMesh(coordinates, faces, decode_edge_ids(point_colors))
 
-    n_faces = faces.shape[0]
-    pv_faces = np.insert(faces, 0, 3, axis=1).flatten()
+def get_tube_mesh(g, n_tube_points=5, smooth=5, order=2, points_per_pixel=0.2):
+    """
+    Return the TubeMesh of a graph (see build_tube_mesh).
+    The mesh is built on the first call, then cached for the graph and these parameters,
+    so that switching the coloring (plot_radii, plot_degrees, plot_components...) does not rebuild it.
+    """
+    meshes = _TUBE_MESHES.setdefault(g, {})
+    key = (n_tube_points, smooth, order, points_per_pixel)
+    if key not in meshes:
+        meshes[key] = build_tube_mesh(g, *key)
+    return meshes[key]
 
-    mesh = pv.PolyData(coordinates, pv_faces, n_faces=n_faces)
-    mesh.point_data['colors'] = colors
+def get_lod_meshes(g, min_radius=None, line_radius=None, chunk_size=None, **mesh_kwargs):
+    """
+    Return the level-of-detail meshes of a graph, built on the first call and cached:
+    a list of (edge_indices, mesh) with one TubeMesh and one LineMesh per spatial chunk.
+        min_radius: edges with a smaller radius are not meshed (e.g. capillaries at coarse zoom): the threshold is
+            chosen by the caller for the zoom of the plot, each threshold being cached apart
+        line_radius: edges with a smaller radius are meshed as lines instead of tubes
+        chunk_size: edge length of the spatial chunks (graph coordinates); None for a single chunk
+        mesh_kwargs: parameters of build_tube_mesh
+    """
+    meshes = _LOD_MESHES.setdefault(g, {})
+    key = (min_radius, line_radius, chunk_size, tuple(sorted(mesh_kwargs.items())))
+    if key not in meshes:
+        radius = g.e_df.array("radius")
+        kept = np.ones(g.n_edges, dtype=bool) if min_radius is None else radius >= min_radius
+        as_lines = np.zeros(g.n_edges, dtype=bool) if line_radius is None else radius < line_radius
+        kept_indices = np.flatnonzero(kept)
+        if chunk_size is None:
+            chunks = [kept_indices]
+        else:
+            starting_coordinates = np.stack([g.e_df.array(f"starting_{c}")[kept_indices] for c in "xyz"], axis=1)
+            chunks = [kept_indices[i] for i in spatial_chunks(starting_coordinates, chunk_size)]
+        edge_groups, is_line = [], []
+        for chunk in chunks:
+            for line in (False, True):
+                edge_indices = np.sort(chunk[as_lines[chunk] == line])
+                if len(edge_indices):
+                    edge_groups.append(edge_indices)
+                    is_line.append(line)
+        # the graph is interpolated and meshed once, and the mesh of each chunk is cut out of it
+        # (no view of the chunk: its ClearMap subgraph would be built and meshed on its own)
+        chunk_meshes = {}
+        tube_groups = [i for i, line in enumerate(is_line) if not line]
+        if tube_groups:
+            tube_meshes = build_tube_mesh(g, **mesh_kwargs).split([edge_groups[i] for i in tube_groups])
+            chunk_meshes.update(zip(tube_groups, tube_meshes))
+        line_groups = [i for i, line in enumerate(is_line) if line]
+        if line_groups:
+            coordinates = np.stack([g.eg_df.array(c) for c in "xyz"], axis=1)
+            point_edge_index = g.eg_df.array("edge_index")
+            for i, point_indices in zip(line_groups, group_by_edge(point_edge_index, [edge_groups[i] for i in line_groups])):
+                chunk_meshes[i] = LineMesh(coordinates[point_indices], np.searchsorted(edge_groups[i], point_edge_index[point_indices]))
+        lod_meshes = [(edge_indices, chunk_meshes[i]) for i, edge_indices in enumerate(edge_groups)]
+        meshes[key] = lod_meshes
+    return meshes[key]
 
-    return mesh.plot(smooth_shading=True, scalars='colors', rgb=True, return_viewer=True)
+def _add_colored_mesh(plotter, mesh, edge_colors, name, **kwargs):
+    """
+    Add the cached mesh (TubeMesh or LineMesh) colored by edge_colors to a plotter, as the actor name:
+    adding it again replaces the actor instead of duplicating it.
+    The mesh itself is added, not a copy, colored by an array of its own per plotter: plotters showing the same
+    cached mesh keep their colors when one of them is recolored. The array is dropped with the plotter.
+    """
+    colors_name = f"colors_{id(plotter)}"
+    if colors_name not in mesh.mesh.point_data:
+        weakref.finalize(plotter, mesh.mesh.point_data.pop, colors_name, None)
+    return plotter.add_mesh(mesh.recolor(edge_colors, name=colors_name), scalars=colors_name, rgb=True, name=name, **kwargs)
 
+def plot_pyvista_lod(g, edge_colors, min_radius=None, line_radius=None, chunk_size=None, plotter=None, **mesh_kwargs):
+    """
+    Level-of-detail rendering of the edges of a graph, colored by edge_colors ((n_edges, 3) RGB array).
+    Small vessels are culled (min_radius) or drawn as lines (line_radius), and the graph is meshed in
+    spatial chunks (chunk_size) that are added to the plotter one by one, from the center outwards.
+    The meshes are cached (see get_lod_meshes): switching the coloring only recolors them.
+    plotter: pyvista.Plotter to which the chunks are added (e.g. returned by a previous call, or shown with
+        interactive_update=True to see them appear progressively); if None, a new plot is shown once all chunks are added.
+    returns: the plotter
+    """
+    new_plotter = plotter is None
+    if new_plotter:
+        plotter = pv.Plotter()
+    edge_colors = np.asarray(edge_colors)
+    for i, (edge_indices, mesh) in enumerate(get_lod_meshes(g, min_radius, line_radius, chunk_size, **mesh_kwargs)):
+        is_tube = isinstance(mesh, TubeMesh)
+        # the tubes are smoothly shaded by their point normals (see TubeMesh)
+        _add_colored_mesh(plotter, mesh, edge_colors[edge_indices], f"lod_{i}", line_width=1 if is_tube else 2)
+        if not new_plotter:
+            plotter.render()
+    if new_plotter:
+        plotter.show(interactive_update=True)
+    return plotter
 
-def plot_radii(graph):
-    if not hasattr(graph, "e_df"):
-        graph = graph.compute_dfs()
-    digitized = digitize_bins(variable=graph.e_df["radius"], n_bins=24)
+def plot_pyvista(g, edge_colors, plotter=None, min_radius=None, line_radius=None, chunk_size=None, **mesh_kwargs):
+    """
+    Plot the edges of a graph as tubes colored by edge_colors ((n_edges, 3) RGB array).
+    The tube mesh is cached (see get_tube_mesh): it is not rebuilt between calls, only colored.
+    plotter: pyvista.Plotter returned by a previous call: its tubes are recolored and rendered instead of opening a new plot.
+        Otherwise the mesh is added to a new pyvista.Plotter, shown without blocking.
+    min_radius, line_radius, chunk_size: level-of-detail rendering of large graphs (see plot_pyvista_lod)
+    mesh_kwargs: parameters of get_tube_mesh (n_tube_points, smooth, order, points_per_pixel)
+    returns: the plotter
+    Examples:
+        plotter = graph.plot_radii()
+        graph.plot_degrees(plotter=plotter)
+    """
+    if g.n_edges != len(edge_colors):
+        raise ValueError(f"graph has {g.n_edges} edges, but {len(edge_colors)} colors were provided.")
+    if (min_radius, line_radius, chunk_size) != (None, None, None):
+        return plot_pyvista_lod(g, edge_colors, min_radius=min_radius, line_radius=line_radius,
+                                chunk_size=chunk_size, plotter=plotter, **mesh_kwargs)
+    new_plotter = plotter is None
+    if new_plotter:
+        plotter = pv.Plotter()
+    # the tubes are smoothly shaded by their point normals (see TubeMesh)
+    _add_colored_mesh(plotter, get_tube_mesh(g, **mesh_kwargs), edge_colors, "tubes")
+    if new_plotter:
+        plotter.show(interactive_update=True)
+    else:
+        plotter.render()
+    return plotter
+
+
+def plot_radii(graph, **kwargs):
+    # only the edge radii are computed (graph.e_df is lazy), and their quantiles once (graph.column_summary)
+    digitized = digitize_bins(variable=graph.e_df.array("radius"), n_bins=24, summary=graph.column_summary("radius"))
     rainbow_colors = make_rainbow_array(32)
     edge_colors = rainbow_colors[digitized]
-    return plot_pyvista(graph, edge_colors)
+    return plot_pyvista(graph, edge_colors, **kwargs)
 
-def plot_degrees(graph):
+def plot_degrees(graph, **kwargs):
     # degrees are clipped to a max value of 5
-    if not hasattr(graph, "e_df"):
-        graph = graph.compute_dfs()
     edge_min_degree = np.clip(graph.e_df["min_degree"].values, 0, 5)
 
     rainbow_colors = make_rainbow_array(6)
     edge_colors = rainbow_colors[edge_min_degree-1]
-    return plot_pyvista(graph, edge_colors)
+    return plot_pyvista(graph, edge_colors, **kwargs)
 
-def plot_components(graph):
+def plot_components(graph, **kwargs):
     # We limit the number of colors to 24
-    if not hasattr(graph, "e_df"):
-        graph = graph.compute_dfs()
     edge_components = graph.e_df["component"] % 24
     rainbow_colors = make_rainbow_array(24)
     edge_colors = rainbow_colors[edge_components]
-    return plot_pyvista(graph, edge_colors)
+    return plot_pyvista(graph, edge_colors, **kwargs)
 
-def plot_edge_value(graph, column_name, n_bins=12, n_colors=24, digitize=True):
+def plot_edge_value(graph, column_name, n_bins=12, n_colors=24, digitize=True, **kwargs):
     if digitize:
-        digitized = digitize_bins(variable=graph.e_df[column_name], n_bins=n_bins)
+        digitized = digitize_bins(variable=graph.e_df.array(column_name), n_bins=n_bins, summary=graph.column_summary(column_name))
     else:
         digitized = graph.e_df[column_name]
     rainbow_colors = make_rainbow_array(n_colors)
     edge_colors = rainbow_colors[digitized]
-    return plot_pyvista(graph, edge_colors)
+    return plot_pyvista(graph, edge_colors, **kwargs)
 
-def annotate_graph(graph, annotation, sampling_interval_graph, sampling_interval_annotation, annotation_name="annotation"):
+def annotate_graph(graph, annotation, sampling_interval_graph, sampling_interval_annotation, annotation_name="annotation", chunk_shape=None):
+    """
+    Add to graph.v_df the label of an annotation volume (e.g. an atlas) at each vertex.
+    The annotation is a path (loaded lazily) or an array-like (numpy, memory-mapped, zarr, dask).
+    It is read chunk by chunk, each chunk once, and is never loaded entirely (see data.sample_volume).
+    The labels are stored with the smallest integer dtype that can hold them.
+    """
     if isinstance(annotation, (str, Path)):
-        annotation = load_img(annotation, swapaxes=False, as_dask_array=False)
-    sampling_interval_graph = np.array(sampling_interval_graph)
-    sampling_interval_annotation = np.array(sampling_interval_annotation)
+        annotation = load_img(annotation, swapaxes=False)
+    scale = np.array(sampling_interval_graph) / np.array(sampling_interval_annotation)
     annotation_shape = np.array(annotation.shape)
     # TODO: check that the annotation and the graph have the same shape
-    graph.v_df[annotation_name] = annotation[tuple(np.clip(np.round(graph.vertex_coordinates() * sampling_interval_graph / sampling_interval_annotation).astype(int), 0, annotation_shape - 1).T)]
+    coordinates = np.stack([graph.v_df.array(c) for c in "xyz"], axis=1)
+    indices = np.clip(np.round(coordinates * scale).astype(np.int64), 0, annotation_shape - 1)
+    graph.v_df[annotation_name] = compact_labels(sample_volume(annotation, indices, chunk_shape=chunk_shape))
+    return graph
+
+def transfer_v_to_e_properties(graph, property_names, method="starting_vertex", suffix=""):
+    """
+    Transfer vertex properties (columns of graph.v_df) to the edges (columns of graph.e_df).
+    The endpoints of the edges are read once for all the properties.
+    method: one of "starting_vertex", "ending_vertex", "mean", "min", "max", "sum"
+    suffix: appended to the names of the edge columns (e.g. "_mean")
+    """
+    starting_vertex, ending_vertex = graph.e_df.array("starting_vertex"), graph.e_df.array("ending_vertex")
+    for property_name in property_names:
+        values = graph.v_df.array(property_name)
+        graph.e_df[property_name + suffix] = vertex_to_edge_values(values, starting_vertex, ending_vertex, method=method)
     return graph
 
 def transfer_v_to_e_property(graph, property_name, method="starting_vertex"):
-    if method == "starting_vertex":
-        graph.e_df[property_name] = graph.v_df.loc[graph.e_df["starting_vertex"], property_name].values
-        return graph
-    elif method == "ending_vertex":
-        graph.e_df[property_name] = graph.v_df.loc[graph.e_df["ending_vertex"], property_name].values
-        return graph
-    elif method == "mean":
-        graph.e_df[property_name] = graph.v_df.loc[graph.e_df[["starting_vertex", "ending_vertex"]].values.flatten(), property_name].values.reshape(-1, 2).mean(axis=1)
-        return graph
-    elif method == "max":
-        graph.e_df[property_name] = graph.v_df.loc[graph.e_df[["starting_vertex", "ending_vertex"]].values.flatten(), property_name].values.reshape(-1, 2).max(axis=1)
-        return graph
-    elif method == "min":
-        graph.e_df[property_name] = graph.v_df.loc[graph.e_df[["starting_vertex", "ending_vertex"]].values.flatten(), property_name].values.reshape(-1, 2).min(axis=1)
-        return graph
-    else:
-        raise ValueError(f"method {method} not recognized")
+    return transfer_v_to_e_properties(graph, [property_name], method=method)
+
+def transfer_e_to_v_properties(graph, property_names, method="mean", suffix="", fill_value=np.nan):
+    """
+    Aggregate edge properties (columns of graph.e_df) on the vertices (columns of graph.v_df),
+    over the edges connected to each vertex (see Graph.adjacency).
+    method: one of "sum", "mean", "min", "max", "count", "mode" (most frequent value, e.g. for atlas regions)
+    suffix: appended to the names of the vertex columns (e.g. "_max")
+    fill_value: value of the vertices without edges (for mean, min, max and mode)
+    """
+    offsets, indices = graph.adjacency()
+    for property_name in property_names:
+        values = graph.e_df.array(property_name)
+        graph.v_df[property_name + suffix] = edge_to_vertex_values(values, offsets, indices, method=method, fill_value=fill_value)
+    return graph
+
+def edge_statistics_by_region(graph, region_name="annotation", columns=("length", "radius"), statistics=("count", "sum", "mean")):
+    """
+    Return a dataframe of statistics of edge columns per region (e.g. total vessel length and mean radius per atlas region).
+    If the edges have no region_name column, each edge takes the region of its starting vertex (see annotate_graph).
+    """
+    if region_name not in graph.e_df:
+        transfer_v_to_e_property(graph, region_name, method="starting_vertex")
+    values = {column: graph.e_df.array(column) for column in columns}
+    return statistics_by_label(graph.e_df.array(region_name), values, statistics=statistics).rename(columns={"label": region_name})
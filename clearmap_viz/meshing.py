@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains utils to build PyVista meshes of graphs.
+It does not depend on ClearMap: the tube meshes themselves are computed in graph_viz with ClearMap's GraphRendering.
+"""
+
+
+import numpy as np
+try:
+    import pyvista as pv
+except ImportError:
+    pv = None
+
+
+def make_vtk_faces(faces):
+    """
+    Return the flat VTK face array [3, a, b, c, 3, ...] of (n_faces, 3) triangles.
+    The array is preallocated and filled in place: a single copy of the faces instead of the
+    two intermediate copies of np.insert(faces, 0, 3, axis=1).flatten().
+    """
+    faces = np.asarray(faces)
+    vtk_faces = np.empty((faces.shape[0], faces.shape[1] + 1), dtype=faces.dtype)
+    vtk_faces[:, 0] = faces.shape[1]
+    vtk_faces[:, 1:] = faces
+    return vtk_faces.reshape(-1)
+
+def make_polydata(coordinates, faces):
+    """
+    Return a PyVista mesh of (n_faces, 3) triangles.
+    With PyVista >= 0.43 the mesh is built from connectivity/offset arrays (PolyData.from_regular_faces),
+    without building the flat VTK face array.
+    """
+    if hasattr(pv.PolyData, "from_regular_faces"):
+        return pv.PolyData.from_regular_faces(coordinates, np.asarray(faces))
+    return pv.PolyData(coordinates, make_vtk_faces(faces))
+
+def get_regular_faces(mesh):
+    """
+    Return the (n_faces, 3) triangles of a PyVista mesh built by make_polydata.
+    """
+    if hasattr(mesh, "regular_faces"):
+        return np.asarray(mesh.regular_faces)
+    return np.asarray(mesh.faces).reshape(-1, 4)[:, 1:]
+
+def group_by_edge(element_edge_index, edge_groups):
+    """
+    Return, for each group of edges, the indices of the elements (points, faces...) of its edges, in their order.
+    input:
+        element_edge_index: (n_elements,) array of the edge index of each element
+        edge_groups: list of arrays of edge indices (disjoint)
+    returns: list of arrays of element indices (one per group)
+    """
+    element_edge_index = np.asarray(element_edge_index)
+    n_edges = max([element_edge_index.max(initial=-1)] + [np.max(edges, initial=-1) for edges in edge_groups]) + 1
+    group_of_edge = np.full(n_edges, len(edge_groups), dtype=np.int64)
+    for i, edges in enumerate(edge_groups):
+        group_of_edge[edges] = i
+    element_group = group_of_edge[element_edge_index]
+    order = np.argsort(element_group, kind="stable")
+    bounds = np.searchsorted(element_group[order], np.arange(len(edge_groups) + 1))
+    return [order[bounds[i]:bounds[i + 1]] for i in range(len(edge_groups))]
+
+def encode_edge_ids(edge_ids):
+    """
+    Return a (n_edges, 3) array of "colors" whose first channel is the edge index.
+    Meshing the edges with these colors gives, for each mesh point, the index of its edge (see decode_edge_ids).
+    edge_ids: number of edges (the edges are indexed 0, 1, 2...), or index of each meshed edge
+        (e.g. GraphView.graph_edge_indices: the edges of a ClearMap subgraph are not in the order of the view)
+    """
+    edge_ids = np.arange(edge_ids) if np.ndim(edge_ids) == 0 else np.asarray(edge_ids)
+    colors = np.zeros((len(edge_ids), 3), dtype=np.float64)
+    colors[:, 0] = edge_ids
+    return colors
+
+def decode_edge_ids(point_colors):
+    """
+    Return the edge index of each mesh point from the colors of a mesh built with encode_edge_ids.
+    """
+    return np.rint(np.asarray(point_colors)[:, 0]).astype(np.int64)
+
+
+class TubeMesh:
+    """
+    PyVista mesh of the edges of a graph, built once and recolored without rebuilding its points and faces.
+    input:
+        coordinates: (n_points, 3) array of mesh point coordinates
+        faces: (n_faces, 3) array of triangles
+        point_edge_index: (n_points,) array of the edge index of each mesh point
+    Examples:
+        tube_mesh = TubeMesh(coordinates, faces, point_edge_index)
+        tube_mesh.recolor(edge_colors).plot(scalars="colors", rgb=True)
+    """
+    def __init__(self, coordinates, faces, point_edge_index):
+        self.mesh = make_polydata(coordinates, faces)
+        self.point_edge_index = np.asarray(point_edge_index)
+        # point normals for smooth shading, computed once: add_mesh(smooth_shading=True) would plot a copy of the mesh
+        if self.mesh.n_cells:
+            self.mesh.compute_normals(cell_normals=False, split_vertices=False, inplace=True)
+
+    def __repr__(self):
+        return f"TubeMesh({self.mesh.n_points} points, {self.mesh.n_cells} faces)"
+
+    def recolor(self, edge_colors, name="colors"):
+        """
+        Set the colors of the mesh points from the (n_edges, 3) edge colors, and return the PyVista mesh.
+        Only the scalar array is rewritten: a plotter showing the mesh is updated on its next render.
+        """
+        self.mesh.point_data[name] = np.asarray(edge_colors)[self.point_edge_index]
+        return self.mesh
+
+    def split(self, edge_groups):
+        """
+        Return a TubeMesh of each group of edges (sorted arrays of edge indices), cut out of this mesh instead of
+        meshing the edges again. The point_edge_index of each is the position of the edge in its group:
+        it is recolored by edge_colors[edge_group].
+        """
+        faces = get_regular_faces(self.mesh)
+        meshes = []
+        # the faces of a tube join points of the same edge
+        for edges, face_indices in zip(edge_groups, group_by_edge(self.point_edge_index[faces[:, 0]], edge_groups)):
+            group_faces = faces[face_indices]
+            point_indices, local_faces = np.unique(group_faces, return_inverse=True)
+            meshes.append(TubeMesh(np.asarray(self.mesh.points)[point_indices], local_faces.reshape(group_faces.shape),
+                                   np.searchsorted(edges, self.point_edge_index[point_indices])))
+        return meshes
+
+
+class LineMesh:
+    """
+    PyVista mesh of the edges of a graph as polylines (one line per edge), recolored like a TubeMesh.
+    Much lighter than tubes: used for small vessels in level-of-detail rendering.
+    input:
+        coordinates: (n_points, 3) array of the edge geometry points, grouped by edge
+        point_edge_index: (n_points,) array of the edge index of each point (sorted)
+    """
+    def __init__(self, coordinates, point_edge_index):
+        self.point_edge_index = np.asarray(point_edge_index)
+        lengths = np.bincount(self.point_edge_index)
+        lengths = lengths[lengths > 0]
+        # VTK lines: [n_0, i_0, ..., n_1, j_0, ...], built in place
+        lines = np.empty(len(lengths) + len(self.point_edge_index), dtype=np.int64)
+        line_starts = np.cumsum(lengths) - lengths
+        header_positions = line_starts + np.arange(len(lengths))
+        is_header = np.zeros(len(lines), dtype=bool)
+        is_header[header_positions] = True
+        lines[header_positions] = lengths
+        lines[~is_header] = np.arange(len(self.point_edge_index))
+        self.mesh = pv.PolyData(np.asarray(coordinates), lines=lines)
+
+    def __repr__(self):
+        return f"LineMesh({self.mesh.n_points} points, {self.mesh.n_lines} lines)"
+
+    def recolor(self, edge_colors, name="colors"):
+        """
+        Set the colors of the line points from the (n_edges, 3) edge colors, and return the PyVista mesh.
+        """
+        self.mesh.point_data[name] = np.asarray(edge_colors)[self.point_edge_index]
+        return self.mesh
+
+
+def spatial_chunks(coordinates, chunk_size):
+    """
+    Group points in cubic chunks of a regular grid, ordered from the center of the points outwards.
+    input:
+        coordinates: (n, 3) array
+        chunk_size: float - edge length of the chunks (same unit as the coordinates)
+    returns: list of arrays of point indices (one per non-empty chunk)
+    """
+    coordinates = np.asarray(coordinates)
+    if len(coordinates) == 0:
+        return []
+    cells = np.floor((coordinates - coordinates.min(axis=0)) / chunk_size).astype(np.int64)
+    cell_ids, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+    center = (cells.max(axis=0) + cells.min(axis=0)) / 2
+    distances = np.linalg.norm(cell_ids - center, axis=1)
+    return [groups[i] for i in np.argsort(distances, kind="stable")]
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains a compact index of the ABA ontology (atlas regions), built once from the JSONL file and cached as NPZ.
+Regions are numbered by their row in the ontology file. Each region also has a rank in the depth-first (pre-order) traversal
+of the tree, and its descendants are the contiguous ranks [tin, tin + size): "all descendants of X" is a slice,
+and the roll-up of values to the ancestors is a difference of cumulative sums.
+"""
+
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.cache import get_cache_entry
+from clearmap_viz.utils import timestamp_info
+
+try:
+    from clearmap_viz.params import ONTOLOGY_FPATH
+except ImportError:
+    ONTOLOGY_FPATH = None
+
+
+# acronyms of the metaregions: each region belongs to its deepest metaregion ancestor
+METAREGIONS = ["universe", "root", "Isocortex", "OLF", "HPF", "CTXsp", "STR", "PAL", "TH", "HY", "MB", "CB", "MY", "P"]
+
+def id_to_index(ids, values):
+    """
+    Return the position of each value in the (unsorted, unique) array of ids (-1 if absent).
+    """
+    ids = np.asarray(ids)
+    values = np.asarray(values)
+    index = np.full(values.shape, -1, dtype=np.int64)
+    if len(ids) == 0:
+        return index
+    order = np.argsort(ids, kind="stable")
+    positions = np.minimum(np.searchsorted(ids, values, sorter=order), len(ids) - 1)
+    found = ids[order[positions]] == values
+    index[found] = order[positions[found]]
+    return index
+
+
+class OntologyIndex:
+    """
+    Arrays of the regions of the ABA ontology (one entry per region, in the order of the ontology file):
+        ids, names, acronyms, colors ("#RRGGBB"), orders (allen_brain_institute_order)
+        parents: row of the parent region (-1 for the root)
+        depths: depth of the region (0 for the root)
+        tin, sizes: pre-order rank of the region and number of regions of its subtree (itself included)
+        preorder: rows of the regions in pre-order (preorder[tin[i]] == i)
+    Examples:
+        ontology = load_ontology_index(ontology_fpath)
+        ontology.descendants(ontology.find("Isocortex"))
+        inclusive_counts = ontology.rollup(counts)  # (n_samples, n_regions)
+    """
+    ARRAYS = ("ids", "names", "acronyms", "colors", "orders", "parents", "depths", "tin", "sizes", "preorder")
+
+    def __init__(self, ids, names, acronyms, colors, orders, parents, depths, tin, sizes, preorder):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=str)
+        self.acronyms = np.asarray(acronyms, dtype=str)
+        self.colors = np.asarray(colors, dtype=str)
+        self.orders = np.asarray(orders, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.depths = np.asarray(depths, dtype=np.int64)
+        self.tin = np.asarray(tin, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.preorder = np.asarray(preorder, dtype=np.int64)
+
+    def __repr__(self):
+        return f"OntologyIndex({len(self)} regions, depth {self.depths.max(initial=0)})"
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_jsonl(cls, fpath):
+        """
+        Build the index from the ABA ontology JSONL file (as ClearMap's ABA_annotation_last.jsonl).
+        The ontology file can be downloaded here:
+            https://raw.githubusercontent.com/ChristophKirst/ClearMap2/master/ClearMap/Resources/Atlas/ABA_annotation_last.jsonl
+        """
+        df = pd.read_json(Path(fpath).expanduser(), lines=True)
+        ids = df["id"].to_numpy(dtype=np.int64)
+        parents = id_to_index(ids, df["parent_structure_id"].fillna(-1).to_numpy(dtype=np.int64))
+        tin, sizes, preorder, depths = cls._euler_tour(parents)
+        return cls(ids=ids,
+                   names=df["name"].astype(str).to_numpy(),
+                   acronyms=df["acronym"].astype(str).to_numpy(),
+                   colors=("#" + df["color_hex_triplet"].astype(str)).to_numpy(),
+                   orders=df["allen_brain_institute_order"].to_numpy(dtype=np.int64),
+                   parents=parents, depths=depths, tin=tin, sizes=sizes, preorder=preorder)
+
+    @staticmethod
+    def _euler_tour(parents):
+        """
+        Return the pre-order rank, subtree size, pre-order and depth of the nodes of a forest given by its parent array.
+        Children are visited in the order of the array.
+        """
+        n = len(parents)
+        order = np.argsort(parents, kind="stable")
+        starts = np.searchsorted(parents[order], np.arange(n))
+        stops = np.searchsorted(parents[order], np.arange(n), side="right")
+        tin = np.zeros(n, dtype=np.int64)
+        depths = np.zeros(n, dtype=np.int64)
+        preorder = []
+        stack = [(root, 0) for root in np.flatnonzero(parents < 0)[::-1]]
+        while stack:
+            node, depth = stack.pop()
+            tin[node] = len(preorder)
+            depths[node] = depth
+            preorder.append(node)
+            stack.extend((child, depth + 1) for child in order[starts[node]:stops[node]][::-1])
+        preorder = np.asarray(preorder, dtype=np.int64)
+        if len(preorder) != n:
+            raise ValueError("The ontology is not a tree (cycle in the parent structure ids)")
+        # subtree sizes: children are accumulated into their parents, deepest first
+        sizes = np.ones(n, dtype=np.int64)
+        for node in preorder[::-1]:
+            if parents[node] >= 0:
+                sizes[parents[node]] += sizes[node]
+        return tin, sizes, preorder, depths
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Load an index saved with save (NPZ file, no pickle).
+        """
+        with np.load(fpath, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def save(self, fpath):
+        """
+        Save the index as a NPZ file.
+        """
+        np.savez(fpath, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    def to_dataframe(self):
+        """
+        Return the index as a dataframe (one row per region).
+        """
+        return pd.DataFrame({name: getattr(self, name) for name in self.ARRAYS if name != "preorder"})
+
+    def index(self, ids):
+        """
+        Return the rows of atlas ids (-1 if absent).
+        """
+        return id_to_index(self.ids, ids)
+
+    def find(self, name):
+        """
+        Return the row of a region from its acronym or name.
+        """
+        rows = np.flatnonzero((self.acronyms == name) | (self.names == name))
+        if len(rows) == 0:
+            raise KeyError(f"No region {name} in the ontology")
+        return int(rows[0])
+
+    def descendants(self, row, include_self=True):
+        """
+        Return the rows of the descendants of a region (pre-order).
+        """
+        start = self.tin[row] + (0 if include_self else 1)
+        return self.preorder[start:self.tin[row] + self.sizes[row]]
+
+    def is_descendant(self, rows, ancestor):
+        """
+        Return whether the regions are descendants of a region (itself included).
+        """
+        tin = self.tin[np.asarray(rows)]
+        return (tin >= self.tin[ancestor]) & (tin < self.tin[ancestor] + self.sizes[ancestor])
+
+    def rollup(self, values):
+        """
+        Add the values of each region to all its ancestors.
+        input:
+            values: (..., n_regions) array, in the order of the ontology
+        returns: (..., n_regions) array of the sums over the subtrees
+        """
+        values = np.asarray(values)
+        cumsum = np.cumsum(values[..., self.preorder], axis=-1)
+        cumsum = np.concatenate([np.zeros_like(cumsum[..., :1]), cumsum], axis=-1)
+        return cumsum[..., self.tin + self.sizes] - cumsum[..., self.tin]
+
+    def ancestor_at_depth(self, depth):
+        """
+        Return, for each region, the row of its ancestor at a given depth (itself at this depth, -1 if shallower).
+        The subtrees of the regions at a given depth are disjoint ranges of pre-order ranks: one searchsorted.
+        """
+        level = np.flatnonzero(self.depths == depth)
+        level = level[np.argsort(self.tin[level])]
+        k = np.searchsorted(self.tin[level], self.tin, side="right") - 1
+        inside = (k >= 0) & (self.tin < self.tin[level[np.maximum(k, 0)]] + self.sizes[level[np.maximum(k, 0)]])
+        return np.where(inside, level[np.maximum(k, 0)], -1)
+
+    def metaregion_index(self, metaregions=METAREGIONS):
+        """
+        Return, for each region, the row of its deepest metaregion ancestor (itself included, -1 if none).
+        """
+        meta = np.full(len(self), -1, dtype=np.int64)
+        rows = np.flatnonzero(np.isin(self.acronyms, metaregions))
+        for row in rows[np.argsort(self.depths[rows], kind="stable")]:
+            meta[self.descendants(row)] = row
+        return meta
+
+    def aggregate(self, values, groups):
+        """
+        Sum the values of the regions (last axis) by group (e.g. ancestor_at_depth or metaregion_index).
+        returns: rows of the groups, (..., n_groups) array of sums (regions of group -1 are ignored)
+        """
+        values = np.asarray(values)
+        groups = np.asarray(groups)
+        rows, inverse = np.unique(groups[groups >= 0], return_inverse=True)
+        sums = np.zeros(values.shape[:-1] + (len(rows),), dtype=values.dtype)
+        np.add.at(np.moveaxis(sums, -1, 0), inverse.ravel(), np.moveaxis(values[..., groups >= 0], -1, 0))
+        return rows, sums
+
+
+def load_ontology_index(fpath=None, cache=True):
+    """
+    Return the OntologyIndex of the ABA ontology JSONL file (default: params.ONTOLOGY_FPATH).
+    With cache=True, the index is built once and saved as NPZ in the cache entry of the file (see cache.get_cache_entry).
+    """
+    if fpath is None and ONTOLOGY_FPATH is None:
+        raise ValueError("No ontology file: pass fpath or set ONTOLOGY_FPATH in params.py")
+    fpath = Path(fpath or ONTOLOGY_FPATH).expanduser()
+    if not cache:
+        return OntologyIndex.from_jsonl(fpath)
+    cache_fpath = get_cache_entry(fpath) / "ontology_index.npz"
+    if cache_fpath.exists():
+        return OntologyIndex.load(cache_fpath)
+    ontology = OntologyIndex.from_jsonl(fpath)
+    ontology.save(cache_fpath)
+    timestamp_info(f"Ontology index of {fpath.name} ({len(ontology)} regions) cached in {cache_fpath}")
+    return ontology
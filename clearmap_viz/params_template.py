@@ -1,2 +1,7 @@
 from pathlib import Path
 LOCAL_CLEARMAP = Path.home() / "code/ChristophKirst/ClearMap2"
+# optional: on-disk cache of the tables computed from graphs and images
+CACHE_DIR = Path.home() / ".cache/clearmap_viz"
+CACHE_MAX_SIZE_GB = 50
+# optional: ABA ontology (JSONL file), indexed by ontology.load_ontology_index
+ONTOLOGY_FPATH = LOCAL_CLEARMAP / "ClearMap/Resources/Atlas/ABA_annotation_last.jsonl"
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains the batch extraction of graph-derived features per atlas region for a cohort of brains:
+each graph is loaded, annotated and summarized in its own worker process, and the per-brain tables are written
+to one Parquet dataset partitioned by brain (<output>/brain=<name>/features.parquet).
+usage: python -m clearmap_viz.pipeline graph_450.gt graph_452.gt --annotation annotation.tif --output features/ [--processes 4]
+"""
+
+
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.graph_utils import load_graph
+from clearmap_viz.graph_viz import annotate_graph, transfer_v_to_e_property, edge_statistics_by_region
+from clearmap_viz.ontology import load_ontology_index
+from clearmap_viz.regions import region_volumes
+from clearmap_viz.utils import timestamp_info, timestamp_ok, timestamp_warning
+
+
+# edges of the radius bins of the vessel length distribution (µm)
+RADIUS_BINS = (0, 2, 3, 4, 5, 7, 10, np.inf)
+# features summarized by default for the cohort (see summarize_features)
+SUMMARY_FEATURES = ("length_sum", "radius_mean", "branch_points_per_mm3", "vessel_mm_per_mm3")
+
+def available_memory():
+    """
+    Return the available memory in bytes (psutil if installed, else /proc/meminfo or sysconf).
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def max_workers(fpaths, processes=None, memory_per_worker_gb=None, memory_factor=8):
+    """
+    Return the number of worker processes: at most processes (default: number of CPUs), and as many as fit in the
+    available memory, each worker needing memory_per_worker_gb (default: memory_factor x the largest graph file).
+    """
+    processes = processes or os.cpu_count()
+    if memory_per_worker_gb is None:
+        memory_per_worker = memory_factor * max(Path(fpath).stat().st_size for fpath in fpaths)
+    else:
+        memory_per_worker = memory_per_worker_gb * 1024**3
+    by_memory = int(available_memory() // max(memory_per_worker, 1))
+    if by_memory < processes:
+        timestamp_warning(f"{by_memory} workers instead of {processes}: {available_memory() / 1024**3:.1f} GB available, "
+                          f"{memory_per_worker / 1024**3:.1f} GB per worker")
+    return max(1, min(processes, by_memory, len(fpaths)))
+
+def region_features(graph, volumes=None, region_name="annotation", radius_bins=RADIUS_BINS):
+    """
+    Return the features of the vessels of an annotated graph per region (atlas id):
+        n_edges, length_sum, radius_mean, radius_std: edges (region of their starting vertex, see edge_statistics_by_region)
+        length_radius_<lo>-<hi>: vessel length per radius bin
+        n_vertices, branch_points: vertices, and vertices of degree >= 3
+        volume_mm3, branch_points_per_mm3, vessel_mm_per_mm3: if the volumes of the regions are given (see regions.region_volumes)
+    The values are those of the regions themselves (not rolled up to their ancestors).
+    """
+    df = edge_statistics_by_region(graph, region_name=region_name, columns=("length", "radius"), statistics=("count", "sum", "mean", "std"))
+    df = df.rename(columns={"count": "n_edges", region_name: "id"})[["id", "n_edges", "length_sum", "radius_mean", "radius_std"]]
+    # length-weighted radius distribution: one bincount over (region, radius bin) pairs
+    regions, inverse = np.unique(graph.e_df.array(region_name), return_inverse=True)
+    bins = np.digitize(graph.e_df.array("radius"), radius_bins[1:-1])
+    n_bins = len(radius_bins) - 1
+    lengths = np.bincount(inverse.ravel() * n_bins + bins, weights=graph.e_df.array("length"), minlength=len(regions) * n_bins)
+    lengths = pd.DataFrame(lengths.reshape(len(regions), n_bins), index=regions,
+                           columns=[f"length_radius_{lo:g}-{hi:g}" for lo, hi in zip(radius_bins[:-1], radius_bins[1:])])
+    df = df.merge(lengths, left_on="id", right_index=True, how="left")
+    # vertices and branch points (degree >= 3)
+    regions, inverse = np.unique(graph.v_df.array(region_name), return_inverse=True)
+    vertices = pd.DataFrame({"id": regions,
+                             "n_vertices": np.bincount(inverse.ravel(), minlength=len(regions)),
+                             "branch_points": np.bincount(inverse.ravel(), weights=graph.v_df.array("degree") >= 3,
+                                                          minlength=len(regions)).astype(np.int64)})
+    df = df.merge(vertices, on="id", how="outer").fillna(0)
+    if volumes is not None:
+        df = df.merge(volumes[["id", "volume_mm3"]], on="id", how="left")
+        df["branch_points_per_mm3"] = df["branch_points"] / df["volume_mm3"]
+        df["vessel_mm_per_mm3"] = df["length_sum"] / 1e3 / df["volume_mm3"]
+    return df.sort_values("id").reset_index(drop=True)
+
+def _process_brain(fpath, output, annotation, sampling_interval_graph, sampling_interval_annotation, volumes):
+    """
+    Extract the features of one brain and write them to <output>/brain=<name>/features.parquet (in a worker process).
+    """
+    name = Path(fpath).stem
+    graph = load_graph(fpath)
+    annotate_graph(graph, annotation, sampling_interval_graph, sampling_interval_annotation)
+    transfer_v_to_e_property(graph, "annotation", method="starting_vertex")
+    features = region_features(graph, volumes=volumes)
+    partition = Path(output) / f"brain={name}"
+    partition.mkdir(parents=True, exist_ok=True)
+    features.to_parquet(partition / "features.parquet", index=False)
+    return name, len(features)
+
+def extract_features(fpaths, output, annotation, sampling_interval_graph, sampling_interval_annotation, ontology_fpath=None,
+                     processes=None, memory_per_worker_gb=None, overwrite=False):
+    """
+    Extract the region features of several brains in parallel (one brain per worker process, see region_features).
+    input:
+        fpaths: list of graph files (the brain is named after the file stem)
+        output: folder of the Parquet dataset, partitioned by brain
+        annotation: annotation volume of atlas ids (path), in the space of the graphs
+        sampling_interval_graph, sampling_interval_annotation: see graph_viz.annotate_graph
+        ontology_fpath: ABA ontology (JSONL) - if given, the region volumes and the densities are computed
+        processes, memory_per_worker_gb: worker limits (see max_workers)
+        overwrite: if False, the brains already in the dataset are skipped
+    returns: list of the names of the processed brains
+    """
+    output = Path(output)
+    if not overwrite:
+        done = [fpath for fpath in fpaths if (output / f"brain={Path(fpath).stem}" / "features.parquet").exists()]
+        if done:
+            timestamp_info(f"Skipping {len(done)} brains already in {output}")
+        fpaths = [fpath for fpath in fpaths if fpath not in done]
+    if not fpaths:
+        return []
+    # the region volumes of the shared annotation are computed once, out-of-core (see regions.region_volumes)
+    volumes = region_volumes(annotation, load_ontology_index(ontology_fpath), voxel_size=sampling_interval_annotation) \
+        if ontology_fpath is not None else None
+    n_workers = max_workers(fpaths, processes=processes, memory_per_worker_gb=memory_per_worker_gb)
+    timestamp_info(f"Extracting the features of {len(fpaths)} brains with {n_workers} workers")
+    processed = []
+    # worker processes are spawned: each one imports ClearMap and loads its own graph
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(_process_brain, str(fpath), str(output), str(annotation), sampling_interval_graph,
+                                   sampling_interval_annotation, volumes): fpath for fpath in fpaths}
+        for future in as_completed(futures):
+            try:
+                name, n_regions = future.result()
+            except Exception as e:
+                timestamp_warning(f"{futures[future]} failed: {e!r}")
+                continue
+            processed.append(name)
+            timestamp_info(f"{name}: {n_regions} regions ({len(processed)}/{len(fpaths)})")
+    timestamp_ok(f"Features of {len(processed)} brains written to {output}")
+    return processed
+
+def load_features(output):
+    """
+    Return the features of all the brains of a dataset (long table with a "brain" column).
+    """
+    features = pd.read_parquet(output)
+    features["brain"] = features["brain"].astype(str)
+    return features
+
+def summarize_features(output, features=SUMMARY_FEATURES, ontology_fpath=None):
+    """
+    Return the summary tables of a cohort: one brains x regions table per feature (dict of feature -> dataframe).
+    If ontology_fpath is given, the regions are named by their acronyms.
+    """
+    df = load_features(output)
+    if ontology_fpath is not None:
+        ontology = load_ontology_index(ontology_fpath)
+        rows = ontology.index(df["id"].to_numpy().astype(np.int64))
+        df["id"] = np.where(rows >= 0, ontology.acronyms[np.maximum(rows, 0)], df["id"].astype(str))
+    return {feature: df.pivot_table(index="brain", columns="id", values=feature, aggfunc="sum")
+            for feature in features if feature in df}
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract graph features per atlas region for several brains, and summarize them.")
+    parser.add_argument("graphs", nargs="+", help="graph files (.gt)")
+    parser.add_argument("--annotation", required=True, help="annotation volume of atlas ids, in the space of the graphs")
+    parser.add_argument("--output", required=True, help="folder of the Parquet dataset (partitioned by brain) and of the summary tables")
+    parser.add_argument("--sampling-interval-graph", type=float, nargs=3, default=(1, 1, 1), metavar=("X", "Y", "Z"))
+    parser.add_argument("--sampling-interval-annotation", type=float, nargs=3, default=(1, 1, 1), metavar=("X", "Y", "Z"))
+    parser.add_argument("--ontology", default=None, help="ABA ontology (JSONL): region volumes, densities and acronyms")
+    parser.add_argument("--processes", type=int, default=None, help="maximum number of worker processes (default: number of CPUs)")
+    parser.add_argument("--memory-per-worker-gb", type=float, default=None, help="memory needed by a worker (default: 8 x the largest graph file)")
+    parser.add_argument("--overwrite", action="store_true", help="process again the brains already in the dataset")
+    args = parser.parse_args()
+    extract_features(args.graphs, args.output, args.annotation, tuple(args.sampling_interval_graph), tuple(args.sampling_interval_annotation),
+                     ontology_fpath=args.ontology, processes=args.processes, memory_per_worker_gb=args.memory_per_worker_gb,
+                     overwrite=args.overwrite)
+    for feature, table in summarize_features(args.output, ontology_fpath=args.ontology).items():
+        table.to_csv(Path(args.output) / f"summary_{feature}.csv")
+        timestamp_ok(f"{feature}: {table.shape[0]} brains x {table.shape[1]} regions -> summary_{feature}.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains utils to display millions of points in napari and to save point annotations incrementally:
+    ZWindowPoints: only the points within a z-window around the current slice are given to the Points layer,
+        found by binary search in the points sorted by z each time the slice changes
+    PointsJournal: append-only binary file of the points added to and removed from a layer (no CSV rewrite)
+It does not depend on napari: the connect methods only use the viewer's dims events and the layer's data events.
+"""
+
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.utils import timestamp_info
+
+
+def load_points(fpath):
+    """
+    Load (n, 3) point coordinates in the (z, y, x) order of napari from:
+        a ClearMap cell table (NPY structured array with x, y, z fields, see cells.load_cells)
+        a NPY (n, 3) array of z, y, x coordinates
+        a CSV file with z, y, x columns (as saved by the cell-pointer notebook)
+        a points journal (.bin, see PointsJournal)
+    """
+    fpath = Path(fpath).expanduser()
+    if fpath.suffix == ".csv":
+        return pd.read_csv(fpath)[["z", "y", "x"]].to_numpy()
+    if fpath.suffix == ".bin":
+        return PointsJournal(fpath).points()
+    points = np.load(fpath, mmap_mode="r", allow_pickle=False)
+    if points.dtype.names is not None:
+        return np.stack([np.asarray(points[c]) for c in "zyx"], axis=1)
+    return np.asarray(points).reshape(-1, 3)
+
+
+class ZWindowPoints:
+    """
+    Points sorted by z, to display only those within a z-window around the current slice.
+    input:
+        coordinates: (n, 3) array in the (z, y, x) order of napari
+        z_window: half-height of the window (in slices): the points with |z - current z| <= z_window are displayed
+    Examples:
+        points = ZWindowPoints(load_points(cells_fpath), z_window=5)
+        layer = viewer.add_points(points.window(0), out_of_slice_display=True, name="cells")
+        points.connect(viewer, layer)
+    """
+    def __init__(self, coordinates, z_window=5):
+        coordinates = np.asarray(coordinates).reshape(-1, 3)
+        self.order = np.argsort(coordinates[:, 0], kind="stable")
+        self.coordinates = coordinates[self.order]
+        self.z = self.coordinates[:, 0]
+        self.z_window = z_window
+
+    def __repr__(self):
+        return f"ZWindowPoints({len(self.z)} points, z_window={self.z_window})"
+
+    def _bounds(self, z):
+        return (np.searchsorted(self.z, z - self.z_window, side="left"),
+                np.searchsorted(self.z, z + self.z_window, side="right"))
+
+    def window_indices(self, z):
+        """
+        Return the indices (in the original coordinates) of the points within the z-window around slice z.
+        """
+        start, stop = self._bounds(z)
+        return self.order[start:stop]
+
+    def window(self, z):
+        """
+        Return the (m, 3) coordinates of the points within the z-window around slice z.
+        """
+        start, stop = self._bounds(z)
+        return self.coordinates[start:stop]
+
+    def connect(self, viewer, layer):
+        """
+        Update the data of a Points layer with the points of the z-window each time the displayed slice changes
+        (viewer.dims.events.current_step). The layer only displays the points: edit them in another layer.
+        returns: the connected callback (to disconnect it: viewer.dims.events.current_step.disconnect(callback))
+        """
+        def callback(event=None):
+            z = layer.world_to_data(viewer.dims.point)[0]
+            layer.data = self.window(z)
+        viewer.dims.events.current_step.connect(callback)
+        callback()
+        return callback
+
+
+class PointsJournal:
+    """
+    Append-only binary file of point edits: one fixed-size record (operation, z, y, x) per added or removed point.
+    The points are those added and not removed since the creation of the file (replayed by points()).
+    input:
+        fpath: path of the journal file (created on the first edit)
+    Examples:
+        journal = PointsJournal(Path.home() / "coords_450.bin")
+        layer = viewer.add_points(journal.points(), name="Points", ndim=3)
+        journal.connect(layer)  # each edit of the layer is appended to the file
+    """
+    DTYPE = np.dtype([("operation", "u1"), ("z", "<f4"), ("y", "<f4"), ("x", "<f4")])
+    ADD, REMOVE = 1, 2
+
+    def __init__(self, fpath):
+        self.fpath = Path(fpath).expanduser()
+
+    def __repr__(self):
+        return f"PointsJournal({self.fpath}, {len(self.records())} records)"
+
+    def records(self):
+        """
+        Return the structured array of all the records of the journal.
+        """
+        if not self.fpath.exists():
+            return np.zeros(0, dtype=self.DTYPE)
+        return np.fromfile(self.fpath, dtype=self.DTYPE)
+
+    def append(self, operation, coordinates):
+        """
+        Append records of one operation (ADD or REMOVE) for (n, 3) z, y, x coordinates.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float32).reshape(-1, 3)
+        if len(coordinates) == 0:
+            return
+        records = np.zeros(len(coordinates), dtype=self.DTYPE)
+        records["operation"] = operation
+        for i, c in enumerate("zyx"):
+            records[c] = coordinates[:, i]
+        with open(self.fpath, "ab") as f:
+            records.tofile(f)
+
+    def points(self):
+        """
+        Return the (n, 3) z, y, x coordinates of the points added and not removed (each point as many times as its net count).
+        """
+        records = self.records()
+        coordinates = np.stack([records[c] for c in "zyx"], axis=1)
+        if len(coordinates) == 0:
+            return coordinates
+        unique, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+        signs = np.where(records["operation"] == self.ADD, 1, -1)
+        counts = np.bincount(inverse.ravel(), weights=signs, minlength=len(unique)).astype(np.int64)
+        return np.repeat(unique, np.clip(counts, 0, None), axis=0)
+
+    def compact(self):
+        """
+        Rewrite the journal with one ADD record per current point.
+        """
+        points = self.points()
+        tmp_fpath = self.fpath.with_name(self.fpath.name + ".tmp")
+        tmp_fpath.unlink(missing_ok=True)
+        PointsJournal(tmp_fpath).append(self.ADD, points)
+        tmp_fpath.touch()
+        tmp_fpath.replace(self.fpath)
+        timestamp_info(f"Journal {self.fpath} compacted to {len(points)} points")
+
+    def record_changes(self, old, new):
+        """
+        Append the differences between two (n, 3) arrays of coordinates (points added, points removed, moved points as both).
+        The arrays are compared as multisets: deleting one of several identical points removes one copy.
+        """
+        old = np.asarray(old, dtype=np.float32).reshape(-1, 3)
+        new = np.asarray(new, dtype=np.float32).reshape(-1, 3)
+        as_rows = lambda a: np.ascontiguousarray(a).view(np.dtype((np.void, a.dtype.itemsize * 3))).ravel()
+        _, first, inverse = np.unique(np.concatenate([as_rows(old), as_rows(new)]), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        points = np.concatenate([old, new])[first]
+        # number of copies of each distinct point in new minus in old
+        net = np.bincount(inverse[len(old):], minlength=len(first)) - np.bincount(inverse[:len(old)], minlength=len(first))
+        self.append(self.REMOVE, np.repeat(points, np.clip(-net, 0, None), axis=0))
+        self.append(self.ADD, np.repeat(points, np.clip(net, 0, None), axis=0))
+
+    def connect(self, layer):
+        """
+        Append the edits of a Points layer (added, removed and moved points) to the journal (layer.events.data).
+        returns: the connected callback (to disconnect it: layer.events.data.disconnect(callback))
+        """
+        state = {"data": np.array(layer.data, dtype=np.float32).reshape(-1, 3)}
+        def callback(event=None):
+            new = np.array(layer.data, dtype=np.float32).reshape(-1, 3)
+            self.record_changes(state["data"], new)
+            state["data"] = new
+        layer.events.data.connect(callback)
+        return callback
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains a z-slab cache to browse large (lazy) 3D images in napari without stuttering:
+the slabs around the displayed slice are read in background threads while the user scrolls.
+It does not depend on napari: PrefetchedArray.connect only uses the viewer's dims and layers events.
+"""
+
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class PrefetchedArray:
+    """
+    Array-like wrapper of a 3D (z, y, x) array (dask array, zarr array, memmap...) that serves z-slabs
+    from a bounded LRU cache, and reads the slabs ahead of and behind a given slice in background threads.
+    input:
+        arr: 3D array-like
+        slab_size: number of z-slices read at once (default: the z-chunk size of the array, if any, else 8)
+        n_slabs: number of slabs prefetched ahead of and behind the current slice
+        max_memory_gb: memory budget of the cache (prefetching never exceeds it)
+        num_workers: number of reading threads
+    Examples:
+        img = PrefetchedArray(load_img(fpath), max_memory_gb=4)
+        layer = viewer.add_image(img)
+        img.connect(viewer, layer)
+    """
+    def __init__(self, arr, slab_size=None, n_slabs=8, max_memory_gb=2, num_workers=4):
+        self.arr = arr
+        self.shape = tuple(arr.shape)
+        self.dtype = np.dtype(arr.dtype)
+        self.ndim = len(self.shape)
+        if slab_size is None:
+            chunks = getattr(arr, "chunksize", None) or getattr(arr, "chunks", None)
+            slab_size = int(chunks[0]) if chunks is not None and np.isscalar(chunks[0]) else 8
+        self.slab_size = max(int(slab_size), 1)
+        self.n_slabs = n_slabs
+        self.max_memory = int(max_memory_gb * 1024**3)
+        self.slab_nbytes = self.slab_size * int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="prefetch")
+        # (event emitter, callback) pairs connected by connect, disconnected by close
+        self._connections = []
+        self.closed = False
+
+    def __repr__(self):
+        return (f"PrefetchedArray({self.shape}, {self.dtype}, slab_size={self.slab_size}, "
+                f"{len(self._cache)} cached slabs / {self.nbytes_cached / 1024**2:.0f} MB)")
+
+    # size and nbytes of the whole array, as numpy (read by napari, e.g. to compute the contrast limits)
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    @property
+    def n_slabs_total(self):
+        return -(-self.shape[0] // self.slab_size)
+
+    @property
+    def nbytes_cached(self):
+        return sum(slab.nbytes for slab in self._cache.values())
+
+    def _read_slab(self, i):
+        z = i * self.slab_size
+        slab = np.asarray(self.arr[z:z + self.slab_size])
+        with self._lock:
+            self._pending.pop(i, None)
+            if not self.closed:
+                self._cache[i] = slab
+                self._cache.move_to_end(i)
+                self._evict()
+        return slab
+
+    def _evict(self):
+        # called with the lock held: drop the least recently used slabs beyond the memory budget (keep at least one)
+        nbytes = sum(slab.nbytes for slab in self._cache.values())
+        while nbytes > self.max_memory and len(self._cache) > 1:
+            _, slab = self._cache.popitem(last=False)
+            nbytes -= slab.nbytes
+
+    def get_slab(self, i):
+        """
+        Return the i-th z-slab: from the cache, from a pending prefetch, or read now.
+        """
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+            future = self._pending.get(i)
+        if future is not None:
+            return future.result()
+        return self._read_slab(i)
+
+    def prefetch(self, z):
+        """
+        Read in the background the slabs around slice z (nearest first), within the memory budget.
+        """
+        i0 = min(max(int(z), 0), self.shape[0] - 1) // self.slab_size
+        max_slabs = max(self.max_memory // max(self.slab_nbytes, 1) - 1, 0)
+        order = [i0] + [i for d in range(1, self.n_slabs + 1) for i in (i0 + d, i0 - d)]
+        order = [i for i in order if 0 <= i < self.n_slabs_total][:max_slabs]
+        with self._lock:
+            if self.closed:
+                return
+            for i in order:
+                if i in self._cache:
+                    self._cache.move_to_end(i)
+                elif i not in self._pending:
+                    self._pending[i] = self._executor.submit(self._read_slab, i)
+
+    def clear(self):
+        """
+        Empty the cache (pending reads are completed).
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """
+        Disconnect the callbacks of connect, stop the reading threads (pending reads are cancelled) and empty the cache.
+        The array can still be read afterwards, without cache nor prefetching.
+        Called when the layer given to connect is removed from the viewer.
+        """
+        for emitter, callback in self._connections:
+            emitter.disconnect(callback)
+        self._connections = []
+        with self._lock:
+            self.closed = True
+            self._cache.clear()
+            self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        z_key = key[0] if key else Ellipsis
+        if isinstance(z_key, (int, np.integer)):
+            z = int(z_key) + (self.shape[0] if z_key < 0 else 0)
+            if not 0 <= z < self.shape[0]:
+                raise IndexError(f"index {z_key} is out of bounds for axis 0 with size {self.shape[0]}")
+            i = z // self.slab_size
+            return self.get_slab(i)[(z - i * self.slab_size,) + key[1:]]
+        if isinstance(z_key, slice):
+            zs = range(*z_key.indices(self.shape[0]))
+            if len(zs) == 0:
+                return np.asarray(self.arr[key])
+            z_min, z_max = min(zs), max(zs) + 1
+            first, last = z_min // self.slab_size, (z_max - 1) // self.slab_size
+            slabs = [self.get_slab(i) for i in range(first, last + 1)]
+            block = slabs[0] if len(slabs) == 1 else np.concatenate(slabs)
+            offset = first * self.slab_size
+            local = slice(z_min - offset, z_max - offset) if zs.step == 1 else np.asarray(zs) - offset
+            return block[(local,) + key[1:]]
+        # Ellipsis, arrays...: not served by the cache
+        return np.asarray(self.arr[key])
+
+    def __array__(self, dtype=None, copy=None):
+        arr = np.asarray(self.arr)
+        return arr if dtype is None else arr.astype(dtype)
+
+    def connect(self, viewer, layer=None):
+        """
+        Prefetch the slabs around the displayed slice each time it changes (viewer.dims.events.current_step),
+        e.g. when scrolling or with visualization.go_to_slice. Nothing is prefetched in 3D display.
+        input:
+            viewer: napari.Viewer
+            layer: napari layer displaying this array - used to convert the world position to the array z (translate, scale);
+                when it is removed from the viewer, the array is closed (see close)
+        returns: the connected callback (disconnected by close)
+        """
+        def callback(event=None):
+            if viewer.dims.ndisplay == 3:
+                return
+            if layer is not None:
+                z = layer.world_to_data(viewer.dims.point)[0]
+            else:
+                z = viewer.dims.current_step[viewer.dims.ndim - self.ndim]
+            self.prefetch(int(round(z)))
+        viewer.dims.events.current_step.connect(callback)
+        self._connections.append((viewer.dims.events.current_step, callback))
+        if layer is not None:
+            def on_removed(event):
+                if event.value is layer:
+                    self.close()
+            viewer.layers.events.removed.connect(on_removed)
+            self._connections.append((viewer.layers.events.removed, on_removed))
+        callback()
+        return callback
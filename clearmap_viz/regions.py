@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains utils to measure atlas regions out-of-core: voxel volumes from a full-resolution annotation volume
+(histogram computed chunk by chunk, in parallel), and density tables combining them with cell counts and vessel lengths.
+"""
+
+
+from pathlib import Path
+
+import dask
+import dask.array as da
+import numpy as np
+import pandas as pd
+
+from clearmap_viz.data import load_img, DEFAULT_ZARR_CHUNKS
+from clearmap_viz.utils import timestamp_info, timestamp_warning
+
+
+def _block_histogram(block):
+    """
+    Return the labels of a block and their number of voxels (hash-based count: no sort of the voxels).
+    """
+    counts = pd.Series(np.asarray(block).ravel()).value_counts(sort=False)
+    return counts.index.to_numpy(), counts.to_numpy()
+
+def label_histogram(annotation, chunks=None, num_workers=None):
+    """
+    Return the number of voxels of each label of an annotation volume, computed chunk by chunk in parallel threads.
+    The volume is never loaded entirely: at most num_workers chunks are in memory at once.
+    input:
+        annotation: path (loaded lazily, see data.load_img) or array-like (numpy, memory-mapped, zarr, dask)
+        chunks: shape of the blocks read at once (default: chunks of the dask array, else DEFAULT_ZARR_CHUNKS)
+        num_workers: number of threads (default: dask default)
+    returns: dataframe with columns "label", "n_voxels" (sorted by label)
+    """
+    if isinstance(annotation, (str, Path)):
+        annotation = load_img(annotation, swapaxes=False, chunks=chunks or DEFAULT_ZARR_CHUNKS)
+    elif not isinstance(annotation, da.Array):
+        annotation = da.from_array(annotation, chunks=chunks or DEFAULT_ZARR_CHUNKS)
+    elif chunks is not None:
+        annotation = annotation.rechunk(chunks)
+    blocks = annotation.to_delayed().ravel()
+    timestamp_info(f"Histogram of {annotation.shape} labels in {len(blocks)} chunks")
+    histograms = dask.compute(*[dask.delayed(_block_histogram)(block) for block in blocks],
+                              scheduler="threads", num_workers=num_workers)
+    labels = np.concatenate([h[0] for h in histograms])
+    counts = np.concatenate([h[1] for h in histograms])
+    labels, inverse = np.unique(labels, return_inverse=True)
+    return pd.DataFrame({"label": labels, "n_voxels": np.bincount(inverse.ravel(), weights=counts).astype(np.int64)})
+
+def region_volumes(annotation, ontology, voxel_size=(1, 1, 1), chunks=None, num_workers=None):
+    """
+    Return the number of voxels and the volume of each region of the ontology, from an annotation volume of atlas ids.
+    input:
+        annotation: path or array-like (see label_histogram)
+        ontology: OntologyIndex (see ontology.load_ontology_index)
+        voxel_size: size of the voxels in µm
+    returns: dataframe in the order of the ontology, with columns "id", "name", "acronym", "n_voxels", "volume_mm3"
+        (voxels of the region itself, not of its descendants: see density_table for rolled-up values)
+    """
+    histogram = label_histogram(annotation, chunks=chunks, num_workers=num_workers)
+    rows = ontology.index(histogram["label"].to_numpy().astype(np.int64))
+    outside = (rows < 0) & (histogram["label"].to_numpy() != 0)
+    if outside.any():
+        timestamp_warning(f"{histogram['n_voxels'][outside].sum():,} voxels have labels outside the ontology: "
+                          f"{histogram['label'][outside].tolist()[:10]}")
+    n_voxels = np.bincount(rows[rows >= 0], weights=histogram["n_voxels"].to_numpy()[rows >= 0], minlength=len(ontology))
+    return pd.DataFrame({"id": ontology.ids, "name": ontology.names, "acronym": ontology.acronyms,
+                         "n_voxels": n_voxels.astype(np.int64),
+                         "volume_mm3": n_voxels * np.prod(voxel_size) / 1e9})
+
+def density_table(volumes, ontology, cell_counts=None, graph=None, region_name="annotation", length_column="length", rollup=True):
+    """
+    Return a table of the volume, cell density and vessel length density of the regions of one brain.
+    input:
+        volumes: dataframe returned by region_volumes
+        ontology: OntologyIndex
+        cell_counts: (n_regions,) counts of the cells of each region, in the order of the ontology
+            (e.g. a row of cells.count_cells, not rolled up)
+        graph: Graph whose vertices are annotated with atlas ids (see graph_viz.annotate_graph) - vessel length per region
+        region_name: column of the atlas ids in the graph tables
+        length_column: column of the edge lengths (same unit as the voxel size of the volumes, µm)
+        rollup: if True, the values of a region include those of its descendants
+    returns: dataframe of the regions of non-zero volume, with columns
+        "id", "name", "acronym", "n_voxels", "volume_mm3", ["cell_count", "cells_per_mm3"], ["vessel_length_mm", "vessel_mm_per_mm3"]
+    """
+    finalize = ontology.rollup if rollup else (lambda values: values)
+    df = volumes[["id", "name", "acronym"]].copy()
+    df["n_voxels"] = finalize(volumes["n_voxels"].to_numpy())
+    df["volume_mm3"] = finalize(volumes["volume_mm3"].to_numpy())
+    if cell_counts is not None:
+        df["cell_count"] = finalize(np.asarray(cell_counts, dtype=np.int64).ravel())
+        df["cells_per_mm3"] = df["cell_count"] / df["volume_mm3"]
+    if graph is not None:
+        from clearmap_viz.graph_viz import edge_statistics_by_region
+        lengths = edge_statistics_by_region(graph, region_name=region_name, columns=(length_column,), statistics=("sum",))
+        rows = ontology.index(lengths[region_name].to_numpy().astype(np.int64))
+        vessel_length = np.bincount(rows[rows >= 0], weights=lengths[f"{length_column}_sum"].to_numpy()[rows >= 0],
+                                    minlength=len(ontology))
+        df["vessel_length_mm"] = finalize(vessel_length) / 1e3
+        df["vessel_mm_per_mm3"] = df["vessel_length_mm"] / df["volume_mm3"]
+    return df[df["n_voxels"] > 0].reset_index(drop=True)
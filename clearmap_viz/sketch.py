@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains a streaming quantile sketch, to bin and summarize columns of 10^8 values chunk by chunk,
+and the precomputed statistics of a column (histograms, min/max, quantiles) from which the plots are drawn.
+The sketch counts the values in logarithmic buckets (as DDSketch): its quantiles are within a relative accuracy
+of the exact ones, its size only depends on the range of the values, and two sketches are merged by adding their counts.
+"""
+
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of the distribution of a column: count, sum, exact min and max, and logarithmic bucket counts.
+    The quantiles are within relative_accuracy of the exact quantiles (e.g. 1%).
+    input:
+        relative_accuracy: float - relative accuracy of the quantiles
+        min_value: float - absolute values below min_value are counted as zeros
+    Examples:
+        sketch = QuantileSketch().update(chunk_1).update(chunk_2)
+        sketch = QuantileSketch.from_array(graph.e_df.array("radius"))
+        bins = sketch.quantiles(np.linspace(0, 1, 24))
+        counts = sketch.histogram(np.linspace(0, 20, 101))
+    """
+    def __init__(self, relative_accuracy=0.01, min_value=1e-12):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.count = 0
+        self.n_nan = 0
+        self.n_zeros = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        # bucket keys (sorted) and counts of the positive and negative values (by absolute value)
+        self.positive = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.negative = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def __repr__(self):
+        return (f"QuantileSketch({self.count:,} values in [{self.min:.3g}, {self.max:.3g}], "
+                f"{len(self.positive[0]) + len(self.negative[0])} buckets)")
+
+    @classmethod
+    def from_array(cls, values, chunk_size=10**7, **kwargs):
+        """
+        Return the sketch of an array-like (numpy, memory-mapped, pandas, zarr, dask...), read chunk by chunk.
+        """
+        sketch = cls(**kwargs)
+        for start in range(0, len(values), chunk_size):
+            sketch.update(values[start:start + chunk_size])
+        return sketch
+
+    @staticmethod
+    def _merge_buckets(buckets, keys, counts):
+        keys, inverse = np.unique(np.concatenate([buckets[0], keys]), return_inverse=True)
+        return keys, np.bincount(inverse.ravel(), weights=np.concatenate([buckets[1], counts]), minlength=len(keys)).astype(np.int64)
+
+    def _keys(self, absolute_values):
+        return np.ceil(np.log(absolute_values) / self.log_gamma).astype(np.int64)
+
+    def update(self, values):
+        """
+        Add a chunk of values (NaNs are counted apart and ignored). Return the sketch.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        is_nan = np.isnan(values)
+        self.n_nan += int(is_nan.sum())
+        values = values[~is_nan]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        is_zero = np.abs(values) < self.min_value
+        self.n_zeros += int(is_zero.sum())
+        for sign, name in [(1, "positive"), (-1, "negative")]:
+            selected = values[(np.sign(values) == sign) & ~is_zero]
+            if len(selected):
+                keys, counts = np.unique(self._keys(np.abs(selected)), return_counts=True)
+                setattr(self, name, self._merge_buckets(getattr(self, name), keys, counts))
+        return self
+
+    def merge(self, other):
+        """
+        Add the values of another sketch (same relative accuracy). Return the sketch.
+        """
+        if not np.isclose(self.gamma, other.gamma):
+            raise ValueError("Sketches of different relative accuracies cannot be merged")
+        self.count += other.count
+        self.n_nan += other.n_nan
+        self.n_zeros += other.n_zeros
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.positive = self._merge_buckets(self.positive, *other.positive)
+        self.negative = self._merge_buckets(self.negative, *other.negative)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    def buckets(self):
+        """
+        Return the representative values of the buckets (increasing) and their counts.
+        """
+        value = lambda keys: 2 * self.gamma ** keys / (self.gamma + 1)
+        values = np.concatenate([-value(self.negative[0][::-1]), [0.0], value(self.positive[0])])
+        counts = np.concatenate([self.negative[1][::-1], [self.n_zeros], self.positive[1]])
+        return np.clip(values, self.min, self.max), counts
+
+    def quantiles(self, q):
+        """
+        Return the approximate quantiles of the values (the quantiles 0 and 1 are the exact min and max).
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        values, counts = self.buckets()
+        ranks = np.cumsum(counts)
+        result = values[np.minimum(np.searchsorted(ranks, q * (self.count - 1), side="right"), len(values) - 1)]
+        return np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+
+    def histogram(self, bins):
+        """
+        Return the (approximate) number of values in each bin, from the bucket counts (edges as np.histogram).
+        """
+        values, counts = self.buckets()
+        return np.histogram(values, bins=bins, weights=counts)[0].astype(np.int64)
+
+    def log_bins(self, n_bins=100):
+        """
+        Return n_bins logarithmic bin edges over the positive values.
+        """
+        low = 2 * self.gamma ** self.positive[0][0] / (self.gamma + 1) if len(self.positive[0]) else 1.0
+        low = max(low, self.min) if self.count and self.min > 0 else low
+        return np.geomspace(low, max(self.max, low), n_bins + 1)
+
+
+class ColumnSummary:
+    """
+    Statistics of a column, computed once by reading it chunk by chunk, from which the plots are drawn
+    in a time that does not depend on the number of values:
+        sketch: QuantileSketch (count, min, max, mean, quantiles)
+        linear_edges, linear_counts: histogram of n_bins linear bins between min and max
+        log_edges, log_counts: histogram of n_bins logarithmic bins over the positive values
+        quantile_levels, quantiles: percentiles 0 to 100
+        discrete_counts: counts of the values 0, 1, 2... of an integer or boolean column (None otherwise,
+            or if the values are negative or above max_discrete_value)
+    Examples:
+        summary = ColumnSummary.from_array(graph.e_df.array("radius"))
+        summary = graph.column_summary("radius")  # cached with the graph
+        plot_histogram(summary.log_counts, summary.log_edges, log_x=True, log_y=True)
+    """
+    def __init__(self, sketch, n_bins=100, discrete_counts=None):
+        self.sketch = sketch
+        self.n_bins = n_bins
+        self.linear_edges = np.linspace(sketch.min, sketch.max, n_bins + 1) if sketch.count else np.linspace(0, 1, n_bins + 1)
+        self.linear_counts = sketch.histogram(self.linear_edges)
+        self.log_edges = sketch.log_bins(n_bins)
+        self.log_counts = sketch.histogram(self.log_edges)
+        self.quantile_levels = np.linspace(0, 1, 101)
+        self.quantiles = sketch.quantiles(self.quantile_levels)
+        self.discrete_counts = discrete_counts
+
+    def __repr__(self):
+        return f"ColumnSummary({self.count:,} values in [{self.min:.3g}, {self.max:.3g}], mean {self.mean:.3g})"
+
+    @classmethod
+    def from_array(cls, values, n_bins=100, chunk_size=10**7, max_discrete_value=10**4, **kwargs):
+        """
+        Return the summary of an array-like (numpy, memory-mapped, pandas, zarr, dask...), read chunk by chunk.
+        kwargs: parameters of QuantileSketch
+        """
+        sketch = QuantileSketch(**kwargs)
+        discrete = np.issubdtype(values.dtype, np.integer) or np.issubdtype(values.dtype, np.bool_)
+        discrete_counts = np.zeros(0, dtype=np.int64)
+        for start in range(0, len(values), chunk_size):
+            chunk = np.asarray(values[start:start + chunk_size]).ravel()
+            sketch.update(chunk)
+            if discrete and len(chunk):
+                discrete = 0 <= chunk.min() and chunk.max() <= max_discrete_value
+                if discrete:
+                    counts = np.bincount(chunk.astype(np.int64), minlength=len(discrete_counts))
+                    counts[:len(discrete_counts)] += discrete_counts
+                    discrete_counts = counts
+        return cls(sketch, n_bins=n_bins, discrete_counts=discrete_counts if discrete else None)
+
+    @property
+    def count(self):
+        return self.sketch.count
+
+    @property
+    def min(self):
+        return self.sketch.min
+
+    @property
+    def max(self):
+        return self.sketch.max
+
+    @property
+    def mean(self):
+        return self.sketch.mean
+
+    def quantile(self, q):
+        """
+        Return approximate quantiles of the column (see QuantileSketch.quantiles).
+        """
+        return self.sketch.quantiles(q)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+__author__ = "Etienne Doumazane"
+__license__ = "MIT"
+__version__ = "0.0.1"
+__maintainer__ = "Etienne Doumazane"
+__email__ = "etienne.doumazane@icm-institute.org"
+__status__ = "Development"
+
+"""
+This module contains a grid-bucket spatial index of 3D points (cells, graph vertices, edge geometry points),
+built once per dataset and cached as NPZ, for fast bounding-box, radius and k-nearest-neighbor queries.
+The points are sorted by grid cell: a query only reads the points of the cells it overlaps.
+"""
+
+
+from pathlib import Path
+
+import numpy as np
+
+from clearmap_viz.cache import get_cache_entry
+from clearmap_viz.cells import load_cells
+from clearmap_viz.graph_tables import ranges_to_indices
+from clearmap_viz.utils import timestamp_info
+
+
+class GridIndex:
+    """
+    Spatial index of (n, 3) points: the points sorted by cell of a regular grid, with the start of each non-empty cell (CSR).
+    Queries return the indices of the points in the original array, sorted.
+    The coordinates of the queries are in the same axis order as the points
+    (x, y, z for ClearMap graphs and cells: see visualization.convert_center_to_slicing with reverse_order=True).
+    Examples:
+        index = GridIndex.build(coordinates)
+        index.query_slicing((slice(100, 200), slice(300, 400), slice(500, 600)))
+        index.radius((150, 350, 550), 20)
+        indices, distances = index.knn((150, 350, 550), k=10)
+    """
+    ARRAYS = ("points", "order", "origin", "cell_size", "grid_shape", "cell_keys", "cell_starts")
+
+    def __init__(self, points, order, origin, cell_size, grid_shape, cell_keys, cell_starts):
+        self.points = np.asarray(points)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.grid_shape = np.asarray(grid_shape, dtype=np.int64)
+        self.cell_keys = np.asarray(cell_keys, dtype=np.int64)
+        self.cell_starts = np.asarray(cell_starts, dtype=np.int64)
+
+    def __repr__(self):
+        return f"GridIndex({len(self)} points, {len(self.cell_keys)} cells of size {self.cell_size:g})"
+
+    def __len__(self):
+        return len(self.points)
+
+    @classmethod
+    def build(cls, coordinates, cell_size=None, points_per_cell=32):
+        """
+        Build the index of (n, 3) coordinates.
+        cell_size: edge length of the grid cells (default: about points_per_cell points per cell on average)
+        """
+        coordinates = np.asarray(coordinates).reshape(-1, 3)
+        n = len(coordinates)
+        origin = coordinates.min(axis=0).astype(np.float64) if n else np.zeros(3)
+        extent = (coordinates.max(axis=0) - origin) if n else np.ones(3)
+        if cell_size is None:
+            cell_size = (np.prod(np.maximum(extent, 1)) * points_per_cell / max(n, 1)) ** (1 / 3)
+        cells = np.floor((coordinates - origin) / cell_size).astype(np.int64)
+        grid_shape = cells.max(axis=0) + 1 if n else np.ones(3, dtype=np.int64)
+        keys = np.ravel_multi_index(tuple(cells.T), tuple(grid_shape))
+        order = np.argsort(keys, kind="stable")
+        cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+        return cls(points=coordinates[order], order=order, origin=origin, cell_size=cell_size, grid_shape=grid_shape,
+                   cell_keys=cell_keys, cell_starts=np.append(cell_starts, n))
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Load an index saved with save (NPZ file, no pickle).
+        """
+        with np.load(fpath, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def save(self, fpath):
+        """
+        Save the index as a NPZ file.
+        """
+        np.savez(fpath, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    def _candidates(self, lower, upper):
+        """
+        Return the positions (in self.points) of the points of the grid cells overlapping the box [lower, upper].
+        """
+        if len(self) == 0 or np.any(np.asarray(upper) < np.asarray(lower)):
+            return np.zeros(0, dtype=np.int64)
+        with np.errstate(invalid="ignore"):
+            cell_lower = np.floor((np.asarray(lower, dtype=np.float64) - self.origin) / self.cell_size)
+            cell_upper = np.floor((np.asarray(upper, dtype=np.float64) - self.origin) / self.cell_size)
+        if np.any(cell_upper < 0) or np.any(cell_lower >= self.grid_shape):
+            return np.zeros(0, dtype=np.int64)
+        cell_lower = np.clip(cell_lower, 0, self.grid_shape - 1).astype(np.int64)
+        cell_upper = np.clip(cell_upper, 0, self.grid_shape - 1).astype(np.int64)
+        n_box_cells = np.prod(cell_upper - cell_lower + 1)
+        if n_box_cells <= len(self.cell_keys):
+            # small box: enumerate its cells and look them up
+            grid = np.meshgrid(*[np.arange(a, b + 1) for a, b in zip(cell_lower, cell_upper)], indexing="ij")
+            keys = np.ravel_multi_index(tuple(g.ravel() for g in grid), tuple(self.grid_shape))
+            positions = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+            cells = positions[self.cell_keys[positions] == keys]
+        else:
+            # large box: test the non-empty cells
+            cell_coordinates = np.stack(np.unravel_index(self.cell_keys, tuple(self.grid_shape)), axis=1)
+            cells = np.flatnonzero(np.all((cell_coordinates >= cell_lower) & (cell_coordinates <= cell_upper), axis=1))
+        return ranges_to_indices(self.cell_starts[cells], self.cell_starts[cells + 1])[0]
+
+    def box(self, lower, upper):
+        """
+        Return the indices of the points with lower <= coordinates < upper (None or +-inf for unbounded axes).
+        """
+        lower = np.array([-np.inf if v is None else v for v in lower], dtype=np.float64)
+        upper = np.array([np.inf if v is None else v for v in upper], dtype=np.float64)
+        candidates = self._candidates(lower, upper)
+        points = self.points[candidates]
+        inside = np.all((points >= lower) & (points < upper), axis=1)
+        return np.sort(self.order[candidates[inside]])
+
+    def query_slicing(self, slicing):
+        """
+        Return the indices of the points within a slicing (tuple of 3 slices, e.g. from convert_center_to_slicing).
+        """
+        return self.box([s.start for s in slicing], [s.stop for s in slicing])
+
+    def query_center(self, center, dimensions):
+        """
+        Return the indices of the points within the box of a given center and dimensions (see convert_slicing_to_center).
+        """
+        dimensions = np.broadcast_to(np.asarray(dimensions, dtype=np.float64), (3,))
+        lower = np.asarray(center, dtype=np.float64) - dimensions // 2
+        return self.box(lower, lower + dimensions)
+
+    def radius(self, center, radius, return_distances=False):
+        """
+        Return the indices of the points within a distance of a center (and their distances if return_distances).
+        """
+        center = np.asarray(center, dtype=np.float64)
+        candidates = self._candidates(center - radius, center + radius)
+        distances = np.linalg.norm(self.points[candidates] - center, axis=1)
+        inside = distances <= radius
+        indices, distances = self.order[candidates[inside]], distances[inside]
+        sort = np.argsort(indices)
+        return (indices[sort], distances[sort]) if return_distances else indices[sort]
+
+    def knn(self, point, k=1):
+        """
+        Return the indices of the k nearest points of a point and their distances (nearest first).
+        The search box is doubled until it contains the k nearest points.
+        """
+        point = np.asarray(point, dtype=np.float64)
+        k = min(k, len(self))
+        half_width = self.cell_size
+        while True:
+            candidates = self._candidates(point - half_width, point + half_width)
+            covers_all = len(candidates) == len(self)
+            if len(candidates) >= k:
+                distances = np.linalg.norm(self.points[candidates] - point, axis=1)
+                nearest = np.argsort(distances, kind="stable")[:k]
+                # the box contains the ball of radius half_width: the k nearest are found if the k-th is within it
+                if covers_all or len(nearest) == 0 or distances[nearest[-1]] <= half_width:
+                    return self.order[candidates[nearest]], distances[nearest]
+            elif covers_all:
+                return np.zeros(0, dtype=np.int64), np.zeros(0)
+            half_width *= 2
+
+
+def load_spatial_index(coordinates, source_path=None, name="points", cell_size=None):
+    """
+    Return the GridIndex of points, cached as NPZ in the cache entry of their source file (see cache.get_cache_entry).
+    input:
+        coordinates: (n, 3) array, or function returning it (only called if the index is not cached)
+        source_path: file the points come from (None: the index is built and not cached)
+        name: name of the index within the cache entry (e.g. "vertices", "edge_geometry", "cells")
+        cell_size: edge length of the grid cells (default: see GridIndex.build) - a cached index of another size is rebuilt
+    """
+    cache_fpath = get_cache_entry(source_path) / f"spatial_{name}.npz" if source_path is not None else None
+    if cache_fpath is not None and cache_fpath.exists():
+        index = GridIndex.load(cache_fpath)
+        if cell_size is None or np.isclose(index.cell_size, cell_size):
+            return index
+    index = GridIndex.build(coordinates() if callable(coordinates) else coordinates, cell_size=cell_size)
+    if cache_fpath is not None:
+        index.save(cache_fpath)
+        timestamp_info(f"Spatial index of {len(index):,} {name} cached in {cache_fpath}")
+    return index
+
+def cells_spatial_index(fpath, fields=("x", "y", "z"), cell_size=None):
+    """
+    Return the GridIndex of the cells of a ClearMap cell table (see cells.load_cells), cached with the file.
+    """
+    coordinates = lambda: np.stack([np.asarray(load_cells(fpath)[field]) for field in fields], axis=1)
+    return load_spatial_index(coordinates, source_path=Path(fpath).expanduser(), name="cells", cell_size=cell_size)
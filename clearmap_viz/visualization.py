@@ -14,20 +14,26 @@ This module contains utils to visualize images in the napari viewer and interact
 from pathlib import Path
 import numpy as np
 import napari
-from clearmap_viz.data import load_img
+from clearmap_viz.data import load_img, load_pyramid, slice_pyramid
+from clearmap_viz.points import load_points, ZWindowPoints, PointsJournal
+from clearmap_viz.prefetch import PrefetchedArray
 from clearmap_viz.utils import timestamp_error, timestamp_info, timestamp_ok, timestamp_warning
 
 #####################################################
 ### Open a file or an array-like object in napari ###
 #####################################################
 
-def view_img(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), **kwargs):
+def view_img(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), multiscale=True, prefetch=False, **kwargs):
     """
     View a 3D image in napari.
     input:
-        source: str or Path - path to the image file or array-like
+        source: str or Path - path to the image file or array-like or list of array-likes (multiscale levels)
         viewer: napari.Viewer - napari viewer to which the image should be added - if None, create a new viewer
         slicing: tuple of 3 slices - slicing of the image to be displayed
+        multiscale: bool - if True and the pyramid of the image file exists (see data.build_pyramid), display it as multiscale
+        prefetch: bool or dict - if True (or a dict of arguments of prefetch.PrefetchedArray, e.g. max_memory_gb),
+            the z-slabs around the displayed slice are read in background threads while scrolling (single-scale images only);
+            the threads and the cached slabs are released when the layer is removed
         translate: bool - if True, the slicing is used to translate the image in the viewer
         kwargs: additional arguments for napari.Viewer.add_image
     """
@@ -35,20 +41,27 @@ def view_img(source, viewer=None, slicing=(slice(None),slice(None),slice(None)),
         viewer = napari.current_viewer()
         if viewer is None:
             viewer = napari.Viewer()
-    if isinstance(source, (str, Path)):
-        source = load_img(source)
     if kwargs.get("translate") == True:
         kwargs["translate"] = list(s.start for s in slicing)
-    viewer.add_image(source[slicing], **kwargs)
+    source = _load_source(source, multiscale, slicing)
+    if isinstance(source, list):
+        viewer.add_image(slice_pyramid(source, slicing), multiscale=True, **kwargs)
+    elif prefetch:
+        source = PrefetchedArray(source, **(prefetch if isinstance(prefetch, dict) else {}))
+        layer = viewer.add_image(source, **kwargs)
+        source.connect(viewer, layer)
+    else:
+        viewer.add_image(source, **kwargs)
     return viewer
 
-def view_labels(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), **kwargs):
+def view_labels(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), multiscale=True, **kwargs):
     """
     View a 3D label image in napari.
     input:
-        source: str or Path - path to the image file or array-like
+        source: str or Path - path to the image file or array-like or list of array-likes (multiscale levels)
         viewer: napari.Viewer - napari viewer to which the image should be added - if None, create a new viewer
         slicing: tuple of 3 slices - slicing of the image to be displayed
+        multiscale: bool - if True and the pyramid of the image file exists (see data.build_pyramid with labels=True), display it as multiscale
         translate: bool - if True, the slicing is used to translate the image in the viewer
         kwargs: additional arguments for napari.Viewer.add_labels
     """
@@ -56,20 +69,37 @@ def view_labels(source, viewer=None, slicing=(slice(None),slice(None),slice(None
         viewer = napari.current_viewer()
         if viewer is None:
             viewer = napari.Viewer()
-    if isinstance(source, (str, Path)):
-        source = load_img(source)
     if kwargs.get("translate") == True:
         kwargs["translate"] = list(s.start for s in slicing)
-    viewer.add_labels(source[slicing], **kwargs)
+    source = _load_source(source, multiscale, slicing)
+    if isinstance(source, list):
+        viewer.add_labels(slice_pyramid(source, slicing), multiscale=True, **kwargs)
+    else:
+        viewer.add_labels(source, **kwargs)
     return viewer
 
-def view_points(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), **kwargs):
+def _load_source(source, multiscale=True, slicing=(slice(None),slice(None),slice(None))):
+    """
+    Return the cropped array of an image file (the crop is read directly from the file, see data.load_img),
+    or the list of its multiscale levels if its pyramid exists (to be cropped with slice_pyramid).
+    Array-like sources are cropped, lists of levels are returned as is.
+    """
+    if isinstance(source, (str, Path)):
+        levels = load_pyramid(source) if multiscale else None
+        return load_img(source, slicing=slicing) if levels is None else levels
+    if isinstance(source, list):
+        return source
+    return source[slicing]
+
+def view_points(source, viewer=None, slicing=(slice(None),slice(None),slice(None)), z_window=None, **kwargs):
     """
     View points in napari.
     input:
-        source: str or Path - path to the coordinates file or array-like
+        source: str or Path - path to the coordinates file (see points.load_points: cell table, NPY, CSV, journal) or array-like
         viewer: napari.Viewer - napari viewer to which the points should be added - if None, create a new viewer
         slicing: tuple of 3 slices - slicing of the points to be displayed
+        z_window: int - if not None, only the points within z_window slices of the current slice are displayed
+            (updated when the slice changes, see points.ZWindowPoints): use it for millions of points
         translate: bool - if True, the slicing is used to translate the points in the viewer
         kwargs: additional arguments for napari.Viewer.add_points
     """
@@ -77,13 +107,41 @@ def view_points(source, viewer=None, slicing=(slice(None),slice(None),slice(None
         viewer = napari.current_viewer()
         if viewer is None:
             viewer = napari.Viewer()
-    # if isinstance(source, (str, Path)):
-    #     source = np.load(source)
+    if isinstance(source, (str, Path)):
+        source = load_points(source)
     # if kwargs.get("translate") == True:
     #     kwargs["translate"] = list(s.start for s in slicing)
-    viewer.add_points(source, **kwargs)
+    if z_window is not None:
+        points = ZWindowPoints(source, z_window=z_window)
+        kwargs.setdefault("out_of_slice_display", True)
+        layer = viewer.add_points(points.window(viewer.dims.current_step[0]), ndim=3, **kwargs)
+        points.connect(viewer, layer)
+    else:
+        viewer.add_points(source, **kwargs)
     return viewer
 
+def annotate_points(journal_path, viewer=None, name="Points", **kwargs):
+    """
+    Add an editable Points layer whose edits are saved incrementally to an append-only journal file (see points.PointsJournal).
+    The points of an existing journal are displayed first: annotation can be resumed across sessions.
+    input:
+        journal_path: str or Path - journal file (e.g. coords_450.bin), created on the first edit
+        viewer: napari.Viewer - if None, the current viewer or a new one
+        kwargs: additional arguments for napari.Viewer.add_points
+    returns: the Points layer
+    Examples:
+        layer = annotate_points(Path.home() / "coords_450.bin", edge_color="red", size=50, face_color="#00000000")
+        coords = load_points(Path.home() / "coords_450.bin")  # (n, 3) z, y, x coordinates
+    """
+    if viewer is None:
+        viewer = napari.current_viewer()
+        if viewer is None:
+            viewer = napari.Viewer()
+    journal = PointsJournal(journal_path)
+    layer = viewer.add_points(journal.points(), name=name, ndim=3, **kwargs)
+    journal.connect(layer)
+    return layer
+
 ########################################################
 ### Utils to convert between slicing and coordinates ###
 ########################################################
@@ -154,6 +212,7 @@ def get_camera_params(viewer=None):
 def go_to_slice(z, viewer=None):
     """
     Go to the given slice in the current viewer.
+    The images opened with view_img(..., prefetch=True) then read the slabs around this slice in the background.
     z: int - slice number
     """
     viewer = viewer or napari.current_viewer()
@@ -22,6 +22,7 @@ import numpy as np
 import pandas as pd
 import tifffile
 
+from clearmap_viz.data import load_img as _load_img
 from icm_tools.utils import timestamp_error, BOLD, RED, ORANGE, GREEN, ENDC, timestamp_info
 
 
@@ -29,25 +30,14 @@ def load_img(fpath, swapaxes=True, as_dask_array=True):
     """
     Load a 3D image from a TIF or a NPY file.
     Note: The array is reoriented to have the first dimension as the z-axis.
+    This is clearmap_viz.data.load_img (lazy, chunked, more formats), kept here for compatibility.
     input: (str or Path)
-    returns: dask array
+    returns: dask array (numpy array if as_dask_array is False)
     """
-    if isinstance(fpath, Path):
-        fpath = str(fpath)
-    if fpath.endswith('.tif') or fpath.endswith('.tiff'):
-        if as_dask_array == False:
-            return tifffile.imread(fpath)
-        store = tifffile.imread(fpath, aszarr=True)
-        return da.from_zarr(store)
-    elif fpath.endswith('.npy'):
-        arr = da.from_array(np.load(fpath, mmap_mode="r"))
-        if not as_dask_array:
-            arr = arr.compute()
-        if swapaxes:
-            arr = arr.swapaxes(0,2)
-        return arr        
-    else:
-        timestamp_error(f"Unknown file format for {fpath}")
+    arr = _load_img(fpath, swapaxes=swapaxes)
+    if not as_dask_array:
+        arr = arr.compute()
+    return arr
 
 def save_json(path, data):
     """
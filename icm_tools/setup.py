@@ -9,5 +9,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     install_requires=[
+        # icm_tools.data loads the images with clearmap_viz.data.load_img (pip install -e <repository root>)
+        "clearmap_viz",
     ],
 )
\ No newline at end of file
@@ -10,4 +10,10 @@ setuptools.setup(
     include_package_data=True,
     install_requires=[
     ],
+    entry_points={
+        "console_scripts": [
+            "clearmap-viz-convert=clearmap_viz.convert:main",
+            "clearmap-viz-features=clearmap_viz.pipeline:main",
+        ],
+    },
 )